@@ -1,27 +1,54 @@
 # DAO.py
 
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import or_
 
 from extensions import db
-from models import User, Reminder
+from models import (User, UserGroup, Reminder, ArchivedReminder, DeliveryOutbox, InboxEntry,
+                    NotificationPreference, PendingNotification, group_members,
+                    reminder_recipients, reminder_group_recipients, delivered_reminders,
+                    archived_reminder_group_recipients, reminder_search_vector)
+from search import InvertedIndex
+from sharding import (active_shard, all_shards, allocate_group_id, allocate_reminder_id, allocate_user,
+                      group_by_group_shard, group_by_home_shard, group_by_reminder_shard, is_sharded,
+                      replicate_users, routed, shard_for_email, shard_for_reminder, shard_for_user,
+                      shard_for_username, shards_for_user, use_shard)
 
+@routed(shard_for_email, 'email')
 def search_user_by_email(email):
     result = User.query.filter_by(email=email).first()
     return result
 
+@routed(shard_for_user, 'user_id')
 def search_user_by_id(user_id):
     result = User.query.filter_by(id=user_id).first()
     return result
 
 def add_user(username, email, password_hash):
+    if is_sharded():
+        # The catalog enforces uniqueness across shards and picks the new user's home
+        try:
+            user_id, shard = allocate_user(username, email)
+        except Exception:
+            db.session.rollback()
+            raise
+        with use_shard(shard):
+            return _add_user(username, email, password_hash, user_id)
+    return _add_user(username, email, password_hash)
+
+def _add_user(username, email, password_hash, user_id=None):
 
     temp_user = User.query.filter(
         (User.username == username) | (User.email == email)
     ).first()
     if temp_user:
+        db.session.rollback()
         raise Exception('User already exists')
     try:
         new_user = User(
+            id=user_id,
             username=username,
             email=email,
             password_hash=password_hash,
@@ -36,6 +63,7 @@ def add_user(username, email, password_hash):
         raise Exception(f"An error occurred while adding new user: {e}")
     return new_user
 
+@routed(shard_for_username, 'username')
 def verify_user(username, password_hash):
     """
     Verifies a user's password.
@@ -53,9 +81,11 @@ def verify_user(username, password_hash):
     else:
         raise Exception('Password does not match')
 
-def add_reminder_for_user_with_id(title, message, due_date, creator_id, recipient_ids):
+@routed(shard_for_user, 'creator_id')
+def add_reminder_for_user_with_id(title, message, due_date, creator_id, recipient_ids, group_ids=None):
     """
     Adds a new reminder to the database and associates it with recipients.
+    Groups are stored as a single recipient row each and expanded to their members on read.
 
     Args:
         title (str): The title of the reminder.
@@ -63,6 +93,9 @@ def add_reminder_for_user_with_id(title, message, due_date, creator_id, recipien
         due_date (datetime): The date and time the reminder is due.
         creator_id (int): The ID of the user who created the reminder.
         recipient_ids (list[int]): A list of user IDs for who should receive the reminder.
+        group_ids (list[int], optional): A list of group IDs whose members should receive the reminder.
+            The creator must own or belong to each group. With shards, each group's owner must
+            also share the creator's home shard.
 
     Returns:
         Reminder: The newly created Reminder object, or None if an error occurred.
@@ -73,9 +106,13 @@ def add_reminder_for_user_with_id(title, message, due_date, creator_id, recipien
         if not creator:
             raise Exception(f"Error: Creator with ID {creator_id} not found.")
 
+        # Recipients living on other shards are referenced through local replicas
+        replicate_users(recipient_ids)
+
         # Create the new reminder instance
         try:
             new_reminder = Reminder(
+                id=allocate_reminder_id(),
                 title=title,
                 message=message,
                 due_date=due_date,
@@ -92,9 +129,32 @@ def add_reminder_for_user_with_id(title, message, due_date, creator_id, recipien
                 raise Exception("Warning: None of the recipient IDs were found.")
             new_reminder.recipients.extend(recipients)
 
+        # Associate whole groups without touching their membership
+        if group_ids:
+            # A group lives on its owner's home shard, and the reminder on its creator's
+            elsewhere = sorted(group_id for shard, ids in group_by_group_shard(group_ids).items()
+                               if shard != active_shard() for group_id in ids)
+            if elsewhere:
+                raise Exception(f"Error: Groups {elsewhere} are stored on another shard than user {creator.id}; "
+                                f"reminders can only be sent to groups whose owner shares the creator's shard.")
+            groups = UserGroup.query.filter(UserGroup.id.in_(group_ids)).all()
+            if len(groups) != len(set(group_ids)):
+                raise Exception("Error: One or more recipient groups were not found.")
+            # Only groups the creator owns or belongs to may be sent to
+            member_of = set(db.session.execute(_group_ids_for_user(creator.id)).scalars())
+            for group in groups:
+                if group.created_by != creator.id and group.id not in member_of:
+                    raise Exception(f"Error: User {creator.id} is not authorized to send to group {group.id}.")
+            new_reminder.recipient_groups.extend(groups)
+
         # Add to the session and commit to the database
         if new_reminder:
             db.session.add(new_reminder)
+            if recipient_ids or group_ids:
+                # Enqueue delivery in the same transaction as the reminder itself
+                db.session.flush()
+                db.session.add(DeliveryOutbox(reminder_id=new_reminder.id, deliver_at=new_reminder.due_date))
+                _add_to_inboxes(new_reminder, [recipient.id for recipient in new_reminder.recipients])
             db.session.commit()
             print(f"Successfully added reminder '{title}'.")
             return new_reminder
@@ -107,10 +167,23 @@ def add_reminder_for_user_with_id(title, message, due_date, creator_id, recipien
         raise e
 
 
+def _group_ids_for_user(user_id):
+    # Subquery of the IDs of every group the user belongs to
+    return db.select(group_members.c.group_id).where(group_members.c.user_id == user_id)
+
+
+def _reminders_received_via_groups(user_id):
+    return (Reminder.query
+            .join(reminder_group_recipients)
+            .filter(reminder_group_recipients.c.group_id.in_(_group_ids_for_user(user_id))))
+
+
+@routed(shard_for_user, 'user_id')
 def get_reminders_for_user(user_id):
     """
     Finds all reminders associated with a specific user.
-    This includes reminders they created and reminders they are set to receive.
+    This includes reminders they created and reminders they are set to receive,
+    either directly or as a member of a recipient group.
 
     Args:
         user_id (int): The ID of the user.
@@ -123,8 +196,16 @@ def get_reminders_for_user(user_id):
     if not user:
         raise Exception(f"Error: User with ID {user_id} not found.")
 
-    # Reminders the user is set to receive
-    received_reminders = user.reminders_to_receive.all()
+    # Reminders sent to the user directly, from their inbox on this shard.
+    # Databases from before the inbox must be backfilled once with `flask check-inbox --repair`
+    received_reminders = InboxEntry.query.filter_by(user_id=user.id).order_by(InboxEntry.due_date).all()
+
+    # Reminders received through a group, from every shard that may have them
+    direct_ids = {entry.reminder_id for entry in received_reminders}
+    for shard in shards_for_user(user.id):
+        with use_shard(shard):
+            received_reminders.extend(reminder for reminder in _reminders_received_via_groups(user.id)
+                                      if reminder.id not in direct_ids)
 
     # Reminders the user created
     created_reminders = user.created_reminders
@@ -135,6 +216,55 @@ def get_reminders_for_user(user_id):
     }
 
 
+def _inbox_row(reminder, user_id):
+    return {
+        "user_id": user_id,
+        "reminder_id": reminder.id,
+        "title": reminder.title,
+        "message": reminder.message,
+        "due_date": reminder.due_date,
+        "created_by": reminder.created_by,
+    }
+
+
+def _add_to_inboxes(reminder, user_ids):
+    # Inbox rows live on each recipient's home shard, which may not be the reminder's
+    for shard, ids in group_by_home_shard(user_ids).items():
+        with use_shard(shard):
+            db.session.execute(InboxEntry.__table__.insert(), [_inbox_row(reminder, user_id) for user_id in ids])
+
+
+def _remove_from_inboxes(reminder_id, user_ids):
+    for shard, ids in group_by_home_shard(user_ids).items():
+        with use_shard(shard):
+            db.session.execute(InboxEntry.__table__.delete().where(
+                InboxEntry.reminder_id == reminder_id, InboxEntry.user_id.in_(ids)
+            ))
+
+
+def _cancel_notifications(reminder_id, user_ids):
+    # Digest rows queued for the reminder, which live on each recipient's home shard
+    for shard, ids in group_by_home_shard(user_ids).items():
+        with use_shard(shard):
+            db.session.execute(PendingNotification.__table__.delete().where(
+                PendingNotification.reminder_id == reminder_id, PendingNotification.user_id.in_(ids)
+            ))
+
+
+def _delete_delivery_records(reminder_ids):
+    # Outbox and ledger rows are only needed while a reminder can still be delivered
+    db.session.execute(DeliveryOutbox.__table__.delete().where(DeliveryOutbox.reminder_id.in_(reminder_ids)))
+    db.session.execute(delivered_reminders.delete().where(delivered_reminders.c.reminder_id.in_(reminder_ids)))
+
+
+def _delivered_user_ids(reminder_id):
+    # Only users with a recorded delivery can have a queued digest row for the reminder
+    return db.session.execute(
+        db.select(delivered_reminders.c.user_id).where(delivered_reminders.c.reminder_id == reminder_id)
+    ).scalars().all()
+
+
+@routed(shard_for_reminder, 'reminder_id')
 def delete_reminder(reminder_id, user_id):
     """
     Deletes a reminder from the database.
@@ -159,6 +289,9 @@ def delete_reminder(reminder_id, user_id):
             raise Exception(f"Error: User {user_id} is not authorized to delete reminder {reminder_id}.")
 
         # Delete the reminder and commit
+        _remove_from_inboxes(reminder_to_delete.id, [recipient.id for recipient in reminder_to_delete.recipients])
+        _cancel_notifications(reminder_to_delete.id, _delivered_user_ids(reminder_to_delete.id))
+        _delete_delivery_records([reminder_to_delete.id])
         db.session.delete(reminder_to_delete)
         db.session.commit()
 
@@ -169,6 +302,7 @@ def delete_reminder(reminder_id, user_id):
         db.session.rollback()
         raise e
 
+@routed(shard_for_reminder, 'reminder_id')
 def add_recipient_to_reminder(reminder_id, user_to_add_id):
     """
     Adds a user as a recipient to an existing reminder.
@@ -185,6 +319,7 @@ def add_recipient_to_reminder(reminder_id, user_to_add_id):
         if not reminder:
             raise Exception(f"Error: Reminder with ID {reminder_id} not found.")
 
+        replicate_users([user_to_add_id])
         user_to_add = User.query.get(user_to_add_id)
         if not user_to_add:
             raise Exception(f"Error: User with ID {user_to_add_id} not found.")
@@ -198,6 +333,8 @@ def add_recipient_to_reminder(reminder_id, user_to_add_id):
 
         # Add the new recipient and commit
         reminder.recipients.append(user_to_add)
+        db.session.add(DeliveryOutbox(reminder_id=reminder.id, user_id=user_to_add.id, deliver_at=reminder.due_date))
+        _add_to_inboxes(reminder, [user_to_add.id])
         print("debug")
         db.session.commit()
         print(f"Successfully added {user_to_add.username} to reminder '{reminder.title}'.")
@@ -207,6 +344,7 @@ def add_recipient_to_reminder(reminder_id, user_to_add_id):
         db.session.rollback()
         raise Exception(f"An error occurred while adding a recipient: {e}")
 
+@routed(shard_for_reminder, 'reminder_id')
 def remove_recipient_from_reminder(reminder_id, user_to_remove_id):
     """
     Removes a user as a recipient from an existing reminder.
@@ -233,6 +371,20 @@ def remove_recipient_from_reminder(reminder_id, user_to_remove_id):
 
         # Remove the recipient and commit
         reminder.recipients.remove(user_to_remove)
+        DeliveryOutbox.query.filter(
+            DeliveryOutbox.reminder_id == reminder.id,
+            DeliveryOutbox.user_id == user_to_remove.id,
+            DeliveryOutbox.delivered_at.is_(None),
+        ).delete(synchronize_session=False)
+        _remove_from_inboxes(reminder.id, [user_to_remove.id])
+        # A member of one of the reminder's groups still receives it
+        via_group = db.session.execute(
+            db.select(group_members.c.user_id)
+            .join(reminder_group_recipients, reminder_group_recipients.c.group_id == group_members.c.group_id)
+            .where(reminder_group_recipients.c.reminder_id == reminder.id, group_members.c.user_id == user_to_remove.id)
+        ).first()
+        if not via_group:
+            _cancel_notifications(reminder.id, [user_to_remove.id])
         db.session.commit()
         print(f"Successfully removed {user_to_remove.username} from reminder '{reminder.title}'.")
         return True
@@ -240,6 +392,7 @@ def remove_recipient_from_reminder(reminder_id, user_to_remove_id):
     except Exception as e:
         db.session.rollback()
         raise Exception(f"An error occurred while removing a recipient: {e}")
+@routed(shard_for_reminder, 'reminder_id')
 def get_reminders(reminder_id):
     try:
         reminder = Reminder.query.get(reminder_id)
@@ -249,4 +402,742 @@ def get_reminders(reminder_id):
         else:
             return reminder
     except Exception as e:
-        raise Exception(f"An error occurred while getting reminders: {e}")
\ No newline at end of file
+        raise Exception(f"An error occurred while getting reminders: {e}")
+
+
+def archive_past_reminders(before, batch_size=500):
+    """
+    Moves reminders that were due before a cutoff into cold storage.
+    Work is committed in batches so the hot reminder table is never locked for long.
+    Reminders that still have undelivered outbox entries are left until they are delivered.
+    The outbox and delivery records of archived reminders are deleted.
+
+    Args:
+        before (datetime): Reminders with a due date earlier than this are archived.
+        batch_size (int): The number of reminders moved per transaction.
+
+    Returns:
+        int: The number of reminders that were archived.
+    """
+    archived = 0
+    for shard in all_shards():
+        with use_shard(shard):
+            archived += _archive_shard(before, batch_size)
+    return archived
+
+
+def _archive_shard(before, batch_size):
+    archived = 0
+    while True:
+        try:
+            undelivered = db.exists().where(DeliveryOutbox.reminder_id == Reminder.id,
+                                            DeliveryOutbox.delivered_at.is_(None))
+            batch = (Reminder.query
+                     .filter(Reminder.due_date < before, ~undelivered)
+                     .order_by(Reminder.id)
+                     .limit(batch_size)
+                     .all())
+            if not batch:
+                _purge_delivery_records()
+                return archived
+
+            for reminder in batch:
+                # Archived reminders drop out of the received list along with the hot table
+                _remove_from_inboxes(reminder.id, [recipient.id for recipient in reminder.recipients])
+                db.session.add(ArchivedReminder(
+                    id=reminder.id,
+                    title=reminder.title,
+                    message=reminder.message,
+                    due_date=reminder.due_date,
+                    created_by=reminder.created_by,
+                    archived_at=datetime.utcnow(),
+                    recipients=list(reminder.recipients),
+                    recipient_groups=list(reminder.recipient_groups),
+                ))
+                db.session.delete(reminder)
+            _delete_delivery_records([reminder.id for reminder in batch])
+            db.session.commit()
+            archived += len(batch)
+        except Exception as e:
+            db.session.rollback()
+            raise Exception(f"An error occurred while archiving reminders: {e}")
+
+
+def _purge_delivery_records():
+    # Records left behind for reminders deleted or archived before they were cleaned up with them
+    hot_ids = db.select(Reminder.id)
+    db.session.execute(DeliveryOutbox.__table__.delete().where(DeliveryOutbox.reminder_id.not_in(hot_ids)))
+    db.session.execute(delivered_reminders.delete().where(delivered_reminders.c.reminder_id.not_in(hot_ids)))
+    db.session.commit()
+
+
+@routed(shard_for_user, 'user_id')
+def get_archived_reminders_for_user(user_id):
+    """
+    Finds all archived reminders associated with a specific user.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        dict: A dictionary containing archived 'created' and 'received' reminders.
+    """
+    user = User.query.get(user_id)
+    if not user:
+        raise Exception(f"Error: User with ID {user_id} not found.")
+
+    received = []
+    for shard in shards_for_user(user.id):
+        with use_shard(shard):
+            received.extend(user.archived_reminders_to_receive.union(
+                ArchivedReminder.query
+                .join(archived_reminder_group_recipients)
+                .filter(archived_reminder_group_recipients.c.group_id.in_(_group_ids_for_user(user.id)))
+            ).all())
+
+    return {
+        "created": ArchivedReminder.query.filter_by(created_by=user.id).all(),
+        "received": received
+    }
+
+
+@routed(shard_for_user, 'user_id')
+def search_reminders_for_user(user_id, query, page=1, per_page=20):
+    """
+    Full-text search over the title and message of reminders a user created or receives.
+    Uses the tsvector GIN index on PostgreSQL. Elsewhere an in-process inverted index is
+    built from the user's reminders on every call, which is only fit for development.
+
+    Args:
+        user_id (int): The ID of the user searching.
+        query (str): The search text.
+        page (int): The 1-based page of results to return.
+        per_page (int): The number of results per page.
+
+    Returns:
+        dict: The ranked 'results' for the page and the 'total' number of matches.
+    """
+    user = User.query.get(user_id)
+    if not user:
+        raise Exception(f"Error: User with ID {user_id} not found.")
+
+    def scope():
+        return Reminder.query.filter(or_(
+            Reminder.created_by == user.id,
+            Reminder.recipients.any(User.id == user.id),
+            Reminder.recipient_groups.any(UserGroup.id.in_(_group_ids_for_user(user.id))),
+        ))
+    offset = (page - 1) * per_page
+    shards = shards_for_user(user.id)
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        ts_query = db.func.plainto_tsquery(db.literal_column("'simple'"), query)
+        rank = db.func.ts_rank(reminder_search_vector, ts_query)
+        ranked, total = [], 0
+        # Each shard returns its best offset + per_page matches; the page is cut from the merge
+        for shard in shards:
+            with use_shard(shard):
+                matches = scope().filter(reminder_search_vector.op('@@')(ts_query))
+                ranked.extend(matches
+                              .add_columns(rank)
+                              .order_by(rank.desc(), Reminder.due_date)
+                              .limit(offset + per_page)
+                              .all())
+                total += matches.count()
+        ranked.sort(key=lambda match: (-match[1], match[0].due_date))
+        return {"results": [reminder for reminder, _ in ranked[offset:offset + per_page]], "total": total}
+
+    index = InvertedIndex()
+    for shard in shards:
+        with use_shard(shard):
+            for reminder in scope():
+                index.add(reminder)
+    ranked = index.search(query)
+    return {"results": ranked[offset:offset + per_page], "total": len(ranked)}
+
+
+@routed(shard_for_user, 'creator_id')
+def create_group(name, creator_id, member_ids=None):
+    """
+    Creates a recipient group that reminders can be shared with as a whole.
+
+    Args:
+        name (str): The display name of the group.
+        creator_id (int): The ID of the user creating the group.
+        member_ids (list[int], optional): The IDs of the users in the group.
+
+    Returns:
+        UserGroup: The newly created group.
+    """
+    try:
+        creator = User.query.get(creator_id)
+        if not creator:
+            raise Exception(f"Error: Creator with ID {creator_id} not found.")
+
+        new_group = UserGroup(id=allocate_group_id(), name=name, created_by=creator.id, created_at=datetime.utcnow())
+        db.session.add(new_group)
+        db.session.flush()
+
+        if member_ids:
+            _insert_group_members(new_group.id, member_ids)
+        db.session.commit()
+        print(f"Successfully created group '{name}'.")
+        return new_group
+
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while creating a group: {e}")
+
+
+@routed(shard_for_user, 'user_id')
+def add_members_to_group(group_id, user_id, member_ids):
+    """
+    Adds users to an existing group. Only the creator of the group may change it.
+
+    Args:
+        group_id (int): The ID of the group to modify.
+        user_id (int): The ID of the user making the change.
+        member_ids (list[int]): The IDs of the users to add. Existing members are skipped.
+
+    Returns:
+        int: The number of members that were added.
+    """
+    try:
+        group = UserGroup.query.get(group_id)
+        if not group:
+            raise Exception(f"Error: Group with ID {group_id} not found.")
+        if group.created_by != user_id:
+            raise Exception(f"Error: User {user_id} is not authorized to modify group {group_id}.")
+
+        existing = set(db.session.execute(
+            db.select(group_members.c.user_id)
+            .where(group_members.c.group_id == group.id, group_members.c.user_id.in_(member_ids))
+        ).scalars())
+        added = _insert_group_members(group.id, [member_id for member_id in member_ids if member_id not in existing])
+        db.session.commit()
+        return added
+
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while adding group members: {e}")
+
+
+def _insert_group_members(group_id, member_ids):
+    # Bulk insert so that large groups do not go through the ORM one user at a time
+    member_ids = set(member_ids)
+    if not member_ids:
+        return 0
+    replicate_users(member_ids)
+    found = db.session.execute(db.select(User.id).where(User.id.in_(member_ids))).scalars().all()
+    if len(found) != len(member_ids):
+        raise Exception("Error: One or more group members were not found.")
+    db.session.execute(group_members.insert(), [
+        {"group_id": group_id, "user_id": member_id} for member_id in found
+    ])
+    return len(found)
+
+
+@routed(shard_for_reminder, 'reminder_id')
+def iter_recipient_ids_for_reminder(reminder_id, batch_size=1000):
+    """
+    Streams the IDs of everyone who should receive a reminder, expanding group membership.
+    Users reached both directly and through one or more groups are yielded once.
+
+    Args:
+        reminder_id (int): The ID of the reminder.
+        batch_size (int): The maximum number of IDs fetched per query.
+
+    Yields:
+        list[int]: Batches of recipient user IDs in ascending order.
+    """
+    recipient_ids = db.union(
+        db.select(reminder_recipients.c.user_id.label('user_id'))
+        .where(reminder_recipients.c.reminder_id == reminder_id),
+        db.select(group_members.c.user_id.label('user_id'))
+        .join(reminder_group_recipients, reminder_group_recipients.c.group_id == group_members.c.group_id)
+        .where(reminder_group_recipients.c.reminder_id == reminder_id),
+    ).subquery()
+
+    # Keyset pagination keeps each batch query cheap regardless of group size
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            db.select(recipient_ids.c.user_id)
+            .where(recipient_ids.c.user_id > last_id)
+            .order_by(recipient_ids.c.user_id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]
+
+
+def get_outbox_reminder(reminder_id):
+    """
+    Finds the reminder an outbox entry on the active shard refers to.
+    Unlike get_reminders, database errors are raised as they are rather than reported as not found.
+
+    Args:
+        reminder_id (int): The ID of the reminder.
+
+    Returns:
+        Reminder: The reminder, or None if it was deleted or archived.
+    """
+    return db.session.get(Reminder, reminder_id)
+
+
+def claim_outbox_batch(worker_id, batch_size=100, lease_seconds=60):
+    """
+    Leases the next due outbox entries to a worker, oldest delivery time first.
+    Like the other outbox functions it works on the active shard; see dispatcher.drain_outbox.
+    Entries leased by a worker that crashed become claimable again once the lease expires.
+
+    Args:
+        worker_id (str): A name unique to the claiming worker process.
+        batch_size (int): The maximum number of entries to claim.
+        lease_seconds (int): How long the worker owns the entries before they may be reclaimed.
+
+    Returns:
+        list[DeliveryOutbox]: The claimed entries in delivery order.
+    """
+    now = datetime.utcnow()
+    claimable = (
+        DeliveryOutbox.delivered_at.is_(None),
+        DeliveryOutbox.deliver_at <= now,
+        or_(DeliveryOutbox.lease_expires_at.is_(None), DeliveryOutbox.lease_expires_at < now),
+    )
+    try:
+        candidates = (db.session.query(DeliveryOutbox.id)
+                      .filter(*claimable)
+                      .order_by(DeliveryOutbox.deliver_at, DeliveryOutbox.id)
+                      .limit(batch_size)
+                      .with_for_update(skip_locked=True)
+                      .all())
+
+        # The conditional update makes the claim safe even where SKIP LOCKED is unsupported
+        claimed = []
+        for (entry_id,) in candidates:
+            updated = (DeliveryOutbox.query
+                       .filter(DeliveryOutbox.id == entry_id, *claimable)
+                       .update({
+                           DeliveryOutbox.lease_owner: worker_id,
+                           DeliveryOutbox.lease_expires_at: now + timedelta(seconds=lease_seconds),
+                           DeliveryOutbox.attempts: DeliveryOutbox.attempts + 1,
+                       }, synchronize_session=False))
+            if updated:
+                claimed.append(entry_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while claiming outbox entries: {e}")
+
+    if not claimed:
+        return []
+    return (DeliveryOutbox.query
+            .filter(DeliveryOutbox.id.in_(claimed))
+            .order_by(DeliveryOutbox.deliver_at, DeliveryOutbox.id)
+            .all())
+
+
+def _lease_held(entry_id, worker_id, lease_seconds):
+    # Extends the worker's lease, returning False if another worker has taken the entry over
+    return bool(DeliveryOutbox.query
+                .filter(DeliveryOutbox.id == entry_id,
+                        DeliveryOutbox.lease_owner == worker_id,
+                        DeliveryOutbox.delivered_at.is_(None))
+                .update({DeliveryOutbox.lease_expires_at: datetime.utcnow() + timedelta(seconds=lease_seconds)},
+                        synchronize_session=False))
+
+
+def renew_outbox_lease(entry_id, worker_id, lease_seconds=60):
+    """
+    Extends a worker's lease on an outbox entry before it sends more notifications.
+
+    Args:
+        entry_id (int): The outbox entry being worked on.
+        worker_id (str): The worker holding the lease.
+        lease_seconds (int): The new lease length.
+
+    Returns:
+        bool: False if another worker has taken the entry over, True otherwise.
+    """
+    try:
+        held = _lease_held(entry_id, worker_id, lease_seconds)
+        db.session.commit()
+        return held
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while renewing an outbox lease: {e}")
+
+
+def get_undelivered_recipient_ids(reminder_id, user_ids):
+    """
+    Filters out the users that have already been sent a reminder.
+
+    Args:
+        reminder_id (int): The ID of the reminder.
+        user_ids (list[int]): Candidate recipient IDs.
+
+    Returns:
+        list[int]: The IDs from user_ids with no recorded delivery, in their original order.
+    """
+    delivered = set(db.session.execute(
+        db.select(delivered_reminders.c.user_id)
+        .where(delivered_reminders.c.reminder_id == reminder_id, delivered_reminders.c.user_id.in_(user_ids))
+    ).scalars())
+    return [user_id for user_id in user_ids if user_id not in delivered]
+
+
+def record_deliveries(entry_id, worker_id, reminder_id, user_ids, lease_seconds=60):
+    """
+    Records that a batch of users was sent a reminder and renews the worker's lease.
+    The sends have already happened, so they are recorded even if the lease was lost meanwhile.
+
+    Args:
+        entry_id (int): The outbox entry being worked on.
+        worker_id (str): The worker holding the lease.
+        reminder_id (int): The ID of the reminder that was sent.
+        user_ids (list[int]): The users the reminder was sent to.
+        lease_seconds (int): The new lease length.
+
+    Returns:
+        bool: False if the lease was lost, True otherwise.
+    """
+    try:
+        held = _lease_held(entry_id, worker_id, lease_seconds)
+        # Another worker holding the lease may have sent and recorded some of the same users
+        unrecorded = get_undelivered_recipient_ids(reminder_id, user_ids) if user_ids else []
+        if unrecorded:
+            now = datetime.utcnow()
+            db.session.execute(delivered_reminders.insert(), [
+                {"reminder_id": reminder_id, "user_id": user_id, "delivered_at": now} for user_id in unrecorded
+            ])
+        db.session.commit()
+        return held
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while recording deliveries: {e}")
+
+
+def complete_outbox_entry(entry_id, worker_id):
+    """
+    Marks a leased outbox entry as fully delivered.
+
+    Args:
+        entry_id (int): The outbox entry to complete.
+        worker_id (str): The worker holding the lease.
+
+    Returns:
+        bool: False if the worker no longer held the lease, True otherwise.
+    """
+    try:
+        completed = (DeliveryOutbox.query
+                     .filter(DeliveryOutbox.id == entry_id,
+                             DeliveryOutbox.lease_owner == worker_id,
+                             DeliveryOutbox.delivered_at.is_(None))
+                     .update({DeliveryOutbox.delivered_at: datetime.utcnow()}, synchronize_session=False))
+        db.session.commit()
+        return bool(completed)
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while completing an outbox entry: {e}")
+
+
+def check_inbox(repair=False, batch_size=1000):
+    """
+    Compares every inbox with the reminder_recipients rows it is derived from.
+    Reports entries that are missing, out of date, or left over from removed recipients,
+    and optionally rewrites them from the source tables. Repairing is also how the inbox is
+    backfilled when upgrading a database created before it existed.
+
+    Args:
+        repair (bool): Whether to fix the differences that are found.
+        batch_size (int): The number of reminders or inbox rows checked per query.
+
+    Returns:
+        dict: The number of 'missing', 'stale' and 'orphaned' inbox entries found.
+    """
+    found = {"missing": 0, "stale": 0, "orphaned": 0}
+    try:
+        for shard in all_shards():
+            with use_shard(shard):
+                _check_inbox_sources(found, repair, batch_size)
+                _check_inbox_orphans(found, repair, batch_size)
+            if repair:
+                db.session.commit()
+        return found
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while checking inboxes: {e}")
+
+
+def _check_inbox_sources(found, repair, batch_size):
+    # Walk the reminders stored on the active shard and compare their recipients' inbox rows
+    last_id = 0
+    while True:
+        reminders = (Reminder.query
+                     .filter(Reminder.id > last_id)
+                     .order_by(Reminder.id)
+                     .limit(batch_size)
+                     .all())
+        if not reminders:
+            return
+        last_id = reminders[-1].id
+        by_id = {reminder.id: reminder for reminder in reminders}
+
+        expected = {}
+        for reminder_id, user_id in db.session.execute(
+                db.select(reminder_recipients.c.reminder_id, reminder_recipients.c.user_id)
+                .where(reminder_recipients.c.reminder_id.in_(by_id))):
+            expected[(user_id, reminder_id)] = _inbox_row(by_id[reminder_id], user_id)
+
+        for shard, user_ids in group_by_home_shard({user_id for user_id, _ in expected}).items():
+            with use_shard(shard):
+                actual = {
+                    (row["user_id"], row["reminder_id"]): dict(row)
+                    for row in db.session.execute(
+                        db.select(InboxEntry.__table__)
+                        .where(InboxEntry.user_id.in_(user_ids), InboxEntry.reminder_id.in_(by_id))
+                    ).mappings()
+                }
+                wrong = []
+                for key, row in expected.items():
+                    if key[0] not in user_ids:
+                        continue
+                    if key not in actual:
+                        found["missing"] += 1
+                        wrong.append(row)
+                    elif actual[key] != row:
+                        found["stale"] += 1
+                        wrong.append(row)
+                if repair and wrong:
+                    for row in wrong:
+                        db.session.execute(InboxEntry.__table__.delete().where(
+                            InboxEntry.user_id == row["user_id"], InboxEntry.reminder_id == row["reminder_id"]
+                        ))
+                    db.session.execute(InboxEntry.__table__.insert(), wrong)
+
+
+def _check_inbox_orphans(found, repair, batch_size):
+    # Walk the inbox rows stored on the active shard and confirm each one still has a recipient row
+    last_key = (0, 0)
+    while True:
+        keys = db.session.execute(
+            db.select(InboxEntry.user_id, InboxEntry.reminder_id)
+            .where(db.tuple_(InboxEntry.user_id, InboxEntry.reminder_id) > db.tuple_(*last_key))
+            .order_by(InboxEntry.user_id, InboxEntry.reminder_id)
+            .limit(batch_size)
+        ).all()
+        if not keys:
+            return
+        last_key = tuple(keys[-1])
+
+        existing = set()
+        for shard, reminder_ids in group_by_reminder_shard({reminder_id for _, reminder_id in keys}).items():
+            with use_shard(shard):
+                existing.update(tuple(row) for row in db.session.execute(
+                    db.select(reminder_recipients.c.user_id, reminder_recipients.c.reminder_id)
+                    .where(reminder_recipients.c.reminder_id.in_(reminder_ids),
+                           reminder_recipients.c.user_id.in_({user_id for user_id, _ in keys}))
+                ))
+
+        orphans = [tuple(key) for key in keys if tuple(key) not in existing]
+        found["orphaned"] += len(orphans)
+        if repair:
+            for user_id, reminder_id in orphans:
+                db.session.execute(InboxEntry.__table__.delete().where(
+                    InboxEntry.user_id == user_id, InboxEntry.reminder_id == reminder_id
+                ))
+
+
+@routed(shard_for_user, 'user_id')
+def get_notification_preferences(user_id):
+    """
+    Gets a user's digest and quiet-hours settings.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        NotificationPreference: The stored settings, or unsaved defaults if there are none.
+    """
+    user = User.query.get(user_id)
+    if not user:
+        raise Exception(f"Error: User with ID {user_id} not found.")
+    return user.notification_preference or NotificationPreference(user_id=user.id)
+
+
+@routed(shard_for_user, 'user_id')
+def set_notification_preferences(user_id, digest_window_minutes=None, quiet_hours_start=None, quiet_hours_end=None):
+    """
+    Saves a user's digest and quiet-hours settings.
+
+    Args:
+        user_id (int): The ID of the user.
+        digest_window_minutes (int, optional): How long to gather reminders into one digest.
+            None uses the app default and 0 sends each reminder on its own.
+        quiet_hours_start (time, optional): UTC time from which nothing is sent.
+        quiet_hours_end (time, optional): UTC time at which held notifications are sent.
+
+    Returns:
+        NotificationPreference: The saved settings.
+    """
+    try:
+        user = User.query.get(user_id)
+        if not user:
+            raise Exception(f"Error: User with ID {user_id} not found.")
+        if digest_window_minutes is not None and digest_window_minutes < 0:
+            raise Exception("Error: digest_window_minutes cannot be negative.")
+        if (quiet_hours_start is None) != (quiet_hours_end is None):
+            raise Exception("Error: quiet hours need both a start and an end.")
+
+        preference = user.notification_preference or NotificationPreference(user_id=user.id)
+        preference.digest_window_minutes = digest_window_minutes
+        preference.quiet_hours_start = quiet_hours_start
+        preference.quiet_hours_end = quiet_hours_end
+        db.session.add(preference)
+        db.session.commit()
+        return preference
+
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while saving notification preferences: {e}")
+
+
+def _in_quiet_hours(preference, moment):
+    start, end = preference.quiet_hours_start, preference.quiet_hours_end
+    if start is None or start == end:
+        return False
+    clock = moment.time()
+    if start < end:
+        return start <= clock < end
+    # Quiet hours that run past midnight, e.g. 22:00 to 07:00
+    return clock >= start or clock < end
+
+
+def _quiet_hours_end(preference, moment):
+    # The first end of quiet hours after the given moment
+    end = datetime.combine(moment.date(), preference.quiet_hours_end)
+    return end if end > moment else end + timedelta(days=1)
+
+
+def _notification_send_time(preference, now):
+    """
+    Works out when a notification for this user may go out, or None to send it right away.
+    """
+    window = preference.digest_window_minutes if preference else None
+    if window is None:
+        window = current_app.config.get('NOTIFICATION_DIGEST_WINDOW_MINUTES', 0)
+    send_after = now + timedelta(minutes=window)
+
+    if preference and _in_quiet_hours(preference, send_after):
+        send_after = _quiet_hours_end(preference, send_after)
+    return send_after if send_after > now else None
+
+
+def queue_notifications(reminder, user_ids, now=None):
+    """
+    Coalescing stage of the dispatcher. Notifications for users who gather reminders into
+    digests, or who are in their quiet hours, are stored as PendingNotification rows on
+    the user's home shard. Nothing is committed, so the rows are saved together with the
+    caller's delivery records.
+
+    Args:
+        reminder (Reminder): The reminder being delivered.
+        user_ids (list[int]): The recipients it is being delivered to.
+        now (datetime, optional): The current time, defaults to utcnow.
+
+    Returns:
+        list[int]: The recipients that should be sent the reminder immediately.
+    """
+    now = now or datetime.utcnow()
+    immediate = []
+    for shard, ids in group_by_home_shard(user_ids).items():
+        with use_shard(shard):
+            preferences = {
+                preference.user_id: preference
+                for preference in NotificationPreference.query.filter(NotificationPreference.user_id.in_(ids))
+            }
+            queued = []
+            for user_id in ids:
+                send_after = _notification_send_time(preferences.get(user_id), now)
+                if send_after is None:
+                    immediate.append(user_id)
+                else:
+                    queued.append({
+                        "user_id": user_id,
+                        "reminder_id": reminder.id,
+                        "title": reminder.title,
+                        "due_date": reminder.due_date,
+                        "send_after": send_after,
+                    })
+            if queued:
+                db.session.execute(PendingNotification.__table__.insert(), queued)
+    return immediate
+
+
+def flush_notification_digests(send_digest, now=None, batch_size=100):
+    """
+    Sends one digest per user whose earliest pending notification is due, on the active shard.
+    Every pending notification the user has is included, not only the due ones.
+    Users who are in their quiet hours when the flush runs are held until the quiet hours end.
+    A user's rows stay locked while their digest is sent, so concurrent workers skip them
+    and a worker crash leaves them pending to be retried. Sent rows are deleted.
+
+    Args:
+        send_digest (callable): Called as send_digest(user_id, notifications) for each digest.
+        now (datetime, optional): The current time, defaults to utcnow.
+        batch_size (int): The number of users handled per query.
+
+    Returns:
+        int: The number of digests sent.
+    """
+    now = now or datetime.utcnow()
+    sent = 0
+    # Rows that earlier versions marked as sent instead of deleting
+    db.session.execute(PendingNotification.__table__.delete().where(PendingNotification.sent_at.is_not(None)))
+    db.session.commit()
+    while True:
+        user_ids = db.session.execute(
+            db.select(PendingNotification.user_id)
+            .where(PendingNotification.sent_at.is_(None), PendingNotification.send_after <= now)
+            .group_by(PendingNotification.user_id)
+            .order_by(db.func.min(PendingNotification.send_after))
+            .limit(batch_size)
+        ).scalars().all()
+        db.session.commit()
+        if not user_ids:
+            return sent
+
+        flushed = deferred = 0
+        for user_id in user_ids:
+            try:
+                notifications = (PendingNotification.query
+                                 .filter(PendingNotification.user_id == user_id,
+                                         PendingNotification.sent_at.is_(None))
+                                 .order_by(PendingNotification.due_date, PendingNotification.id)
+                                 .with_for_update(skip_locked=True)
+                                 .all())
+                preference = db.session.get(NotificationPreference, user_id)
+                if notifications and preference and _in_quiet_hours(preference, now):
+                    # A worker running late must not send into quiet hours
+                    held_until = _quiet_hours_end(preference, now)
+                    for notification in notifications:
+                        notification.send_after = max(notification.send_after, held_until)
+                    deferred += 1
+                elif notifications:
+                    send_digest(user_id, notifications)
+                    # Sent rows are deleted rather than kept, so the table only holds what is queued
+                    PendingNotification.query.filter(
+                        PendingNotification.id.in_([notification.id for notification in notifications])
+                    ).delete(synchronize_session=False)
+                    flushed += 1
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error: Digest for user {user_id} failed: {e}")
+        sent += flushed
+        if not flushed and not deferred:
+            # Everything due is locked by other workers or failing; leave it to the next pass
+            return sent
@@ -1,9 +1,12 @@
 import os
+import subprocess
+import sys
 import pytest
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request
 from routes import *
 from unittest.mock import patch, MagicMock
+import DAO
 # Import the db object from extensions.py
 from extensions import db
 # Import your models
@@ -47,6 +50,21 @@ def client():
     with app.test_client() as client: # Create a test client
         yield client # Yield the client for tests to use
 
+@pytest.fixture
+def database():
+    """
+    Creates the schema on a separate app with an in-memory SQLite database and drops it afterwards,
+    so the database configured in DATABASE_URL is never touched.
+    """
+    database_app = Flask("database")
+    database_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(database_app)
+    with database_app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.drop_all()
+
 def test_add_user(client):
     request_data = {
         "username": "username2",
@@ -130,6 +148,309 @@ def test_remove_reminder_success(client):
     assert response.status_code == 200 # Expect 200
 
 
+def test_archive_past_reminders(database):
+    """
+    Tests that past reminders move to cold storage and keep their recipients.
+    """
+    creator = DAO.add_user("archiver", "archiver@example.com", "hash")
+    recipient = DAO.add_user("archive_recipient", "archive_recipient@example.com", "hash")
+    old = DAO.add_reminder_for_user_with_id("Old", "Done", datetime(2020, 1, 1), creator.id, [recipient.id])
+    DAO.add_reminder_for_user_with_id("New", "Soon", datetime(2999, 1, 1), creator.id, [recipient.id])
+    old_id = old.id
+
+    # Undelivered reminders are kept hot until the outbox has sent them
+    from dispatcher import drain_outbox
+    from models import DeliveryOutbox, delivered_reminders
+    assert DAO.archive_past_reminders(datetime(2021, 1, 1), batch_size=1) == 0
+    drain_outbox("worker", lambda user_id, r: None)
+    assert DAO.archive_past_reminders(datetime(2021, 1, 1), batch_size=1) == 1
+    assert DeliveryOutbox.query.filter_by(reminder_id=old_id).count() == 0
+    assert db.session.query(delivered_reminders).filter_by(reminder_id=old_id).count() == 0
+
+    hot = DAO.get_reminders_for_user(recipient.id)
+    assert [reminder.title for reminder in hot["received"]] == ["New"]
+    archived = DAO.get_archived_reminders_for_user(recipient.id)
+    assert [reminder.id for reminder in archived["received"]] == [old_id]
+    assert [reminder.title for reminder in DAO.get_archived_reminders_for_user(creator.id)["created"]] == ["Old"]
+
+def test_search_reminders_for_user(database):
+    """
+    Tests that search is ranked, paginated and scoped to the user's own reminders.
+    """
+    owner = DAO.add_user("searcher", "searcher@example.com", "hash")
+    other = DAO.add_user("stranger", "stranger@example.com", "hash")
+    DAO.add_reminder_for_user_with_id("Dentist", "Dentist appointment, bring dentist card", datetime(2030, 1, 1), owner.id, [])
+    DAO.add_reminder_for_user_with_id("Groceries", "Remember the dentist floss", datetime(2030, 1, 2), other.id, [owner.id])
+    DAO.add_reminder_for_user_with_id("Dentist", "Not shared", datetime(2030, 1, 3), other.id, [])
+
+    found = DAO.search_reminders_for_user(owner.id, "dentist")
+    assert found["total"] == 2
+    assert [reminder.title for reminder in found["results"]] == ["Dentist", "Groceries"]
+
+    second_page = DAO.search_reminders_for_user(owner.id, "dentist", page=2, per_page=1)
+    assert [reminder.title for reminder in second_page["results"]] == ["Groceries"]
+    assert DAO.search_reminders_for_user(owner.id, "dentist card")["total"] == 1
+
+def test_group_recipients_are_expanded_lazily(database):
+    """
+    Tests that a group is stored as one recipient row and expanded on read and delivery.
+    """
+    from models import reminder_group_recipients, reminder_recipients
+    owner = DAO.add_user("team_lead", "team_lead@example.com", "hash")
+    members = [DAO.add_user(f"member{i}", f"member{i}@example.com", "hash") for i in range(5)]
+    member_ids = [member.id for member in members]
+    group = DAO.create_group("Team", owner.id, member_ids[:4])
+    assert DAO.add_members_to_group(group.id, owner.id, member_ids[3:]) == 1
+
+    reminder = DAO.add_reminder_for_user_with_id("Standup", None, datetime(2030, 1, 1), owner.id, [member_ids[0]], [group.id])
+    assert db.session.query(reminder_group_recipients).count() == 1
+    assert db.session.query(reminder_recipients).count() == 1
+
+    batches = list(DAO.iter_recipient_ids_for_reminder(reminder.id, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert sum(batches, []) == sorted(member_ids)
+    assert [r.title for r in DAO.get_reminders_for_user(member_ids[0])["received"]] == ["Standup"]
+    assert [r.title for r in DAO.get_reminders_for_user(member_ids[4])["received"]] == ["Standup"]
+
+    # Members may send to the group; anyone else is refused
+    DAO.add_reminder_for_user_with_id("Retro", None, datetime(2030, 1, 2), member_ids[4], [], [group.id])
+    outsider = DAO.add_user("outsider", "outsider@example.com", "hash")
+    with pytest.raises(Exception, match="not authorized"):
+        DAO.add_reminder_for_user_with_id("Spam", None, datetime(2030, 1, 3), outsider.id, [], [group.id])
+
+def test_outbox_is_drained_once_across_workers(database):
+    """
+    Tests that outbox entries are enqueued with the reminder and delivered once per recipient.
+    """
+    from dispatcher import drain_outbox
+    from models import DeliveryOutbox
+    owner = DAO.add_user("sender", "sender@example.com", "hash")
+    members = [DAO.add_user(f"receiver{i}", f"receiver{i}@example.com", "hash") for i in range(3)]
+    group = DAO.create_group("Receivers", owner.id, [member.id for member in members])
+    reminder = DAO.add_reminder_for_user_with_id("Due", None, datetime(2020, 1, 1), owner.id, [members[0].id], [group.id])
+    late = DAO.add_user("late", "late@example.com", "hash")
+    DAO.add_recipient_to_reminder(reminder.id, late.id)
+    DAO.add_recipient_to_reminder(reminder.id, members[1].id)
+    assert DeliveryOutbox.query.count() == 3
+
+    # A crashed worker's lease blocks others until it expires
+    assert len(DAO.claim_outbox_batch("crashed", batch_size=1, lease_seconds=-1)) == 1
+
+    sent = []
+    # A database error while loading the reminder leaves the entry for a retry
+    with patch('dispatcher.get_outbox_reminder', side_effect=Exception("database unavailable")):
+        drain_outbox("flaky", lambda user_id, r: sent.append(user_id))
+    assert sent == []
+    assert DeliveryOutbox.query.filter(DeliveryOutbox.delivered_at.is_(None)).count() == 3
+    DeliveryOutbox.query.update({DeliveryOutbox.lease_expires_at: None})
+    db.session.commit()
+
+    drain_outbox("worker-a", lambda user_id, r: sent.append(user_id), batch_size=1, recipient_batch_size=2,
+                 send_batch_size=1)
+    drain_outbox("worker-b", lambda user_id, r: sent.append(user_id))
+    assert sorted(sent) == sorted([member.id for member in members] + [late.id])
+    assert DeliveryOutbox.query.filter(DeliveryOutbox.delivered_at.is_(None)).count() == 0
+
+def test_app_import_time_budget():
+    """
+    Tests that importing the app stays within budget and does not load google-auth.
+    """
+    budget_us = int(os.getenv('IMPORT_TIME_BUDGET_US', 1500000))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    )
+    # Lines look like "import time:   self |  cumulative | <indent>module"
+    timings = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            timings[module.strip()] = int(cumulative)
+
+    assert not [module for module in timings if module.startswith("google")]
+    assert timings["app"] < budget_us
+
+def test_inbox_is_maintained_and_rebuilt(database):
+    """
+    Tests that the inbox follows recipient changes and that check_inbox repairs drift.
+    """
+    from models import InboxEntry
+    owner = DAO.add_user("inbox_owner", "inbox_owner@example.com", "hash")
+    first = DAO.add_user("inbox_first", "inbox_first@example.com", "hash")
+    second = DAO.add_user("inbox_second", "inbox_second@example.com", "hash")
+    reminder = DAO.add_reminder_for_user_with_id("Inbox", "Body", datetime(2030, 1, 1), owner.id, [first.id])
+    DAO.add_recipient_to_reminder(reminder.id, second.id)
+    DAO.remove_recipient_from_reminder(reminder.id, first.id)
+
+    assert DAO.get_reminders_for_user(first.id)["received"] == []
+    received = DAO.get_reminders_for_user(second.id)["received"]
+    assert [entry.to_dict() for entry in received] == [reminder.to_dict()]
+    assert DAO.check_inbox() == {"missing": 0, "stale": 0, "orphaned": 0}
+
+    # Simulate drift: a lost row, an outdated title and a leftover row
+    InboxEntry.query.delete()
+    db.session.add(InboxEntry(user_id=first.id, reminder_id=reminder.id, title="Old",
+                              due_date=reminder.due_date, created_by=owner.id))
+    db.session.commit()
+    assert DAO.check_inbox(repair=True) == {"missing": 1, "stale": 0, "orphaned": 1}
+    assert DAO.check_inbox() == {"missing": 0, "stale": 0, "orphaned": 0}
+    assert [entry.title for entry in DAO.get_reminders_for_user(second.id)["received"]] == ["Inbox"]
+
+    DAO.delete_reminder(reminder.id, owner.id)
+    assert InboxEntry.query.count() == 0
+
+def test_due_reminders_are_coalesced_into_digests(database):
+    """
+    Tests that reminders due together become one digest and that quiet hours hold them back.
+    """
+    from datetime import time, timedelta
+    from dispatcher import drain_outbox
+    from models import PendingNotification
+    owner = DAO.add_user("calendar", "calendar@example.com", "hash")
+    busy = DAO.add_user("busy", "busy@example.com", "hash")
+    instant = DAO.add_user("instant", "instant@example.com", "hash")
+    DAO.set_notification_preferences(busy.id, digest_window_minutes=5)
+    for i in range(3):
+        DAO.add_reminder_for_user_with_id(f"Meeting {i}", None, datetime(2020, 1, 1), owner.id, [busy.id, instant.id])
+
+    sent, digests = [], []
+    drain_outbox("worker", lambda user_id, r: sent.append(user_id),
+                 send_digest=lambda user_id, notifications: digests.append((user_id, len(notifications))))
+    assert sent == [instant.id] * 3
+    assert digests == []
+
+    later = datetime.utcnow() + timedelta(minutes=6)
+    DAO.flush_notification_digests(lambda user_id, notifications: digests.append((user_id, len(notifications))), now=later)
+    assert digests == [(busy.id, 3)]
+
+    # Quiet hours past midnight push the digest to the end of the quiet period
+    DAO.set_notification_preferences(busy.id, 5, time(22, 0), time(7, 0))
+    reminder = DAO.get_reminders_for_user(owner.id)["created"][0]
+    assert DAO.queue_notifications(reminder, [busy.id, instant.id], now=datetime(2030, 1, 1, 23, 0)) == [instant.id]
+    db.session.commit()
+    queued = PendingNotification.query.filter(PendingNotification.sent_at.is_(None)).one()
+    assert queued.send_after == datetime(2030, 1, 2, 7, 0)
+
+    # A flush that runs late, inside quiet hours, holds a digest that was due before them
+    DAO.queue_notifications(reminder, [busy.id], now=datetime(2030, 1, 1, 21, 50))
+    db.session.commit()
+    digests.clear()
+
+    def flush(now):
+        return DAO.flush_notification_digests(
+            lambda user_id, notifications: digests.append((user_id, len(notifications))), now=now)
+    assert flush(datetime(2030, 1, 1, 22, 30)) == 0
+    assert {n.send_after for n in PendingNotification.query.filter(PendingNotification.sent_at.is_(None))} == \
+        {datetime(2030, 1, 2, 7, 0)}
+    assert flush(datetime(2030, 1, 2, 7, 0)) == 1
+    assert digests == [(busy.id, 2)]
+    assert PendingNotification.query.count() == 0
+
+    # Deleting a reminder, or removing a recipient, cancels what is still queued
+    cancelled = DAO.add_reminder_for_user_with_id("Cancelled meeting", None, datetime(2020, 1, 1), owner.id, [busy.id])
+    removed = DAO.add_reminder_for_user_with_id("Moved meeting", None, datetime(2020, 1, 1), owner.id, [busy.id, instant.id])
+    drain_outbox("worker", lambda user_id, r: sent.append(user_id))
+    assert PendingNotification.query.count() == 2
+    DAO.delete_reminder(cancelled.id, owner.id)
+    DAO.remove_recipient_from_reminder(removed.id, busy.id)
+    assert flush(datetime(2099, 1, 1, 12, 0)) == 0
+    assert PendingNotification.query.count() == 0
+
+def test_profiler_samples_the_next_request(client):
+    """
+    Tests that only admins can profile and that the next request to an endpoint is sampled.
+    """
+    import time
+    import jwt
+    from profiler import profiler
+
+    def token(user_id):
+        return {"Authorization": f"Bearer {jwt.encode({'sub': user_id}, SECRET_KEY, algorithm='HS256')}"}
+
+    def slow_reminders(user_id):
+        time.sleep(0.1)
+        return {"created": [], "received": []}
+
+    with patch('config.ADMIN_USER_IDS', {"1"}):
+        assert client.post('/admin/profile', json={"requests": 1}, headers=token("2")).status_code == 403
+        assert client.post('/admin/profile', json={"seconds": 1, "requests": 1}, headers=token("1")).status_code == 400
+        assert client.post('/admin/profile', json={"requests": 1, "endpoint": "get_reminder"},
+                           headers=token("1")).status_code == 400
+        response = client.post('/admin/profile', json={"requests": 1, "endpoint": "get_reminder_by_user_id"},
+                               headers=token("1"))
+        assert response.status_code == 202
+        assert response.json["endpoint"] == "api.get_reminder_by_user_id"
+
+        with patch('routes.get_reminders_for_user', side_effect=slow_reminders):
+            client.get('/reminders/get', headers=token("2"))
+        assert not profiler.active
+
+        stacks = client.get('/admin/profile', headers=token("1")).get_data(as_text=True).splitlines()
+        assert stacks and all(line.startswith("api.get_reminder_by_user_id;") for line in stacks)
+        assert sum(int(line.rsplit(" ", 1)[1]) for line in stacks) == profiler.samples
+        assert any("api_test.slow_reminders" in line for line in stacks)
+
+@pytest.fixture
+def sharded_database():
+    """
+    Creates an app with the main database and two extra in-memory SQLite shards.
+    """
+    from sharding import create_all_shards, shard_binds
+    sharded_app = Flask("sharded")
+    sharded_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    sharded_app.config['SQLALCHEMY_BINDS'] = shard_binds(['sqlite://', 'sqlite://'])
+    db.init_app(sharded_app)
+    with sharded_app.app_context():
+        create_all_shards()
+        yield db
+        db.session.remove()
+
+def test_sharded_reminders_fan_out_and_rebalance(sharded_database):
+    """
+    Tests routing by user, cross-shard recipients and moving a user to another shard.
+    """
+    from dispatcher import drain_outbox
+    from sharding import move_user_to_shard, shard_for_reminder, shard_for_user
+    users = [DAO.add_user(f"sharded{i}", f"sharded{i}@example.com", "hash") for i in range(3)]
+    owner, recipient, other = users
+    recipient_id = recipient.id
+    assert len({shard_for_user(user.id) for user in users}) == 3
+
+    reminder = DAO.add_reminder_for_user_with_id("Cross", "shard", datetime(2020, 1, 1), owner.id, [recipient.id])
+    assert shard_for_reminder(reminder.id) == shard_for_user(owner.id)
+    assert DAO.search_user_by_email("sharded1@example.com").id == recipient.id
+    assert [r.title for r in DAO.get_reminders_for_user(recipient.id)["received"]] == ["Cross"]
+    assert DAO.search_reminders_for_user(recipient.id, "shard")["total"] == 1
+
+    sent = []
+    drain_outbox("worker", lambda user_id, r: sent.append(user_id))
+    assert sent == [recipient.id]
+
+    owner_group = DAO.create_group("Owner's", owner.id, [recipient.id])
+    other_group = DAO.create_group("Other's", other.id, [other.id])
+    assert owner_group.id != other_group.id
+
+    assert move_user_to_shard(owner.id, shard_for_user(other.id)) == 1
+    assert shard_for_reminder(reminder.id) == shard_for_user(other.id)
+    assert [r.title for r in DAO.get_reminders_for_user(owner.id)["created"]] == ["Cross"]
+    assert [r.title for r in DAO.get_reminders_for_user(recipient.id)["received"]] == ["Cross"]
+    assert list(DAO.iter_recipient_ids_for_reminder(reminder.id)) == [[recipient.id]]
+    assert DAO.check_inbox() == {"missing": 0, "stale": 0, "orphaned": 0}
+
+    # Group IDs come from the catalog and survive the move
+    grouped = DAO.add_reminder_for_user_with_id("Group", "shard", datetime(2030, 1, 1), owner.id, [], [owner_group.id])
+    assert list(DAO.iter_recipient_ids_for_reminder(grouped.id)) == [[recipient.id]]
+
+    # A member on the group's shard may send to it
+    assert DAO.add_members_to_group(owner_group.id, owner.id, [other.id]) == 1
+    from_member = DAO.add_reminder_for_user_with_id("Member", "shard", datetime(2030, 1, 1), other.id, [], [owner_group.id])
+    assert list(DAO.iter_recipient_ids_for_reminder(from_member.id)) == [sorted([recipient.id, other.id])]
+    # A member on another shard than the group is refused with a clear error
+    with pytest.raises(Exception, match="stored on another shard"):
+        DAO.add_reminder_for_user_with_id("Member", "shard", datetime(2030, 1, 1), recipient.id, [], [owner_group.id])
+    # Instances loaded before a failed call are looked up again rather than reused
+    assert DAO.search_user_by_id(recipient_id).username == "sharded1"
 
 # ----------- Google API Test ---------------
 
@@ -0,0 +1,19 @@
+# config.py
+# Loads the environment once; app.py and routes.py read their settings from here.
+
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+SECRET_KEY = os.getenv('SECRET_KEY')
+GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
+# Reminders due longer ago than this are moved to cold storage by `flask archive-reminders`
+REMINDER_ARCHIVE_AFTER_DAYS = int(os.getenv('REMINDER_ARCHIVE_AFTER_DAYS', 30))
+# Default digest window for users without their own setting; 0 sends each reminder on its own
+NOTIFICATION_DIGEST_WINDOW_MINUTES = int(os.getenv('NOTIFICATION_DIGEST_WINDOW_MINUTES', 0))
+# Extra databases to spread users across, comma separated; DATABASE_URL is always the first shard
+SHARD_DATABASE_URLS = [url.strip() for url in os.getenv('SHARD_DATABASE_URLS', '').split(',') if url.strip()]
+# Users allowed to use the /admin routes, comma separated user ids
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
@@ -0,0 +1,98 @@
+# dispatcher.py
+
+from DAO import (claim_outbox_batch, complete_outbox_entry, flush_notification_digests, get_outbox_reminder,
+                 get_undelivered_recipient_ids, iter_recipient_ids_for_reminder, queue_notifications,
+                 record_deliveries, renew_outbox_lease)
+from extensions import db
+from sharding import all_shards, is_sharded, use_shard
+
+
+def drain_outbox(worker_id, send, batch_size=100, lease_seconds=60, recipient_batch_size=1000, send_digest=None,
+                 send_batch_size=50):
+    """
+    Delivers every outbox entry that is currently due, on every shard, then returns.
+    Several workers may drain the same outbox at once; each entry is leased to one of them.
+    Delivery is at-least-once: after a crash, or a lease lost to a slow send, at most one
+    chunk of send_batch_size notifications may be sent again by the next worker.
+    Recipients who take digests or are in quiet hours are queued by the coalescing stage,
+    and digests that have become due are sent at the end of each shard's pass.
+
+    Args:
+        worker_id (str): A name unique to this worker process.
+        send (callable): Called as send(user_id, reminder) for each notification.
+        send_digest (callable, optional): Called as send_digest(user_id, notifications) for
+            each digest. Defaults to calling send once per queued notification.
+        batch_size (int): The number of outbox entries claimed at a time.
+        lease_seconds (int): How long a claim lasts without progress before others may take it.
+        recipient_batch_size (int): The number of recipients expanded at a time.
+        send_batch_size (int): The number of notifications sent between two delivery records.
+            Sending one chunk must take well under lease_seconds.
+
+    Returns:
+        int: The number of notifications and digests sent.
+    """
+    if send_digest is None:
+        def send_digest(user_id, notifications):
+            for notification in notifications:
+                send(user_id, notification)
+
+    sent = 0
+    for shard in all_shards():
+        with use_shard(shard):
+            sent += _drain_shard(worker_id, send, batch_size, lease_seconds, recipient_batch_size, send_batch_size)
+            sent += flush_notification_digests(send_digest)
+        # Outbox IDs are only unique within a shard, so cached entries must not outlive it
+        if is_sharded():
+            db.session.expunge_all()
+    return sent
+
+
+def _drain_shard(worker_id, send, batch_size, lease_seconds, recipient_batch_size, send_batch_size):
+    sent = 0
+    while True:
+        entries = claim_outbox_batch(worker_id, batch_size, lease_seconds)
+        if not entries:
+            return sent
+        for entry in entries:
+            try:
+                sent += _deliver_entry(entry, worker_id, send, lease_seconds, recipient_batch_size, send_batch_size)
+            except Exception as e:
+                # The lease will expire and the entry will be retried by some worker
+                db.session.rollback()
+                print(f"Error: Delivery of outbox entry {entry.id} failed: {e}")
+
+
+def _deliver_entry(entry, worker_id, send, lease_seconds, recipient_batch_size, send_batch_size):
+    entry_id, reminder_id, user_id = entry.id, entry.reminder_id, entry.user_id
+    # Database errors propagate so that the lease expires and the entry is retried
+    reminder = get_outbox_reminder(reminder_id)
+    if reminder is None:
+        # The reminder was deleted after the entry was claimed
+        complete_outbox_entry(entry_id, worker_id)
+        return 0
+
+    if user_id is not None:
+        batches = [[user_id]]
+    else:
+        batches = iter_recipient_ids_for_reminder(reminder_id, recipient_batch_size)
+
+    sent = 0
+    for batch in batches:
+        for start in range(0, len(batch), send_batch_size):
+            chunk = batch[start:start + send_batch_size]
+            # Renewing right before each chunk keeps the lease ahead of the sends
+            if not renew_outbox_lease(entry_id, worker_id, lease_seconds):
+                print(f"Info: Lease on outbox entry {entry_id} was lost, leaving it to another worker.")
+                return sent
+            pending = get_undelivered_recipient_ids(reminder_id, chunk)
+            # Queued notifications are saved by record_deliveries together with the delivery records
+            immediate = queue_notifications(reminder, pending)
+            for recipient_id in immediate:
+                send(recipient_id, reminder)
+            sent += len(immediate)
+            if not record_deliveries(entry_id, worker_id, reminder_id, pending, lease_seconds):
+                print(f"Info: Lease on outbox entry {entry_id} was lost, leaving it to another worker.")
+                return sent
+
+    complete_outbox_entry(entry_id, worker_id)
+    return sent
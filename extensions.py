@@ -1,4 +1,32 @@
+from contextvars import ContextVar
+
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+
+# Shard (SQLALCHEMY_BINDS key) that queries in the current context run against.
+# Set through sharding.use_shard; None or 'default' means the main database.
+current_shard = ContextVar('current_shard', default=None)
+
+
+class ShardedSession(Session):
+    """
+    Session that sends every statement to the shard selected by current_shard.
+    With no shards configured it behaves exactly like the Flask-SQLAlchemy session.
+    """
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        # With shards, objects are not expired on commit: the routed DAO call has left
+        # use_shard by the time they are read, so a refresh would hit the wrong shard
+        if len(db.engines) > 1:
+            self.expire_on_commit = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = current_shard.get()
+        if bind is None and shard not in (None, 'default'):
+            return self._db.engines[shard]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 
-# Create the SQLAlchemy database object
-db = SQLAlchemy()
\ No newline at end of file
+# Create the SQLAlchemy database object.
+db = SQLAlchemy(session_options={'class_': ShardedSession})
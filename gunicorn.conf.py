@@ -0,0 +1,27 @@
+# gunicorn.conf.py
+# Usage: gunicorn app:app
+#
+# The app is imported once in the master and forked into workers, so imports and
+# module-level state are shared copy-on-write instead of being rebuilt per worker.
+
+import gc
+import os
+
+preload_app = True
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+
+
+def pre_fork(server, worker):
+    # Move everything imported so far out of the GC's reach; otherwise the first
+    # collection in each worker writes to every shared page and un-shares it.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # Connections opened in the master must not be shared between processes
+    from app import app
+    from extensions import db
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
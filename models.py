@@ -10,6 +10,37 @@ reminder_recipients = db.Table('reminder_recipients',
                                db.Column('reminder_id', db.Integer, db.ForeignKey('reminder.id'), primary_key=True)
                                )
 
+# Users belonging to a recipient group
+group_members = db.Table('group_members',
+                         db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                         db.Column('group_id', db.Integer, db.ForeignKey('user_group.id'), primary_key=True, index=True)
+                         )
+
+# Groups a reminder is shared with; members are expanded when the reminder is read or delivered
+reminder_group_recipients = db.Table('reminder_group_recipients',
+                                     db.Column('group_id', db.Integer, db.ForeignKey('user_group.id'), primary_key=True),
+                                     db.Column('reminder_id', db.Integer, db.ForeignKey('reminder.id'), primary_key=True, index=True)
+                                     )
+
+# Cold-storage copy of the junction table for archived reminders
+archived_reminder_recipients = db.Table('archived_reminder_recipients',
+                                        db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                                        db.Column('reminder_id', db.Integer, db.ForeignKey('archived_reminder.id'), primary_key=True)
+                                        )
+
+archived_reminder_group_recipients = db.Table('archived_reminder_group_recipients',
+                                              db.Column('group_id', db.Integer, db.ForeignKey('user_group.id'), primary_key=True),
+                                              db.Column('reminder_id', db.Integer, db.ForeignKey('archived_reminder.id'), primary_key=True, index=True)
+                                              )
+
+
+def _search_vector(title, message):
+    # DAO.search_reminders_for_user must query this exact expression to hit the index
+    return db.func.to_tsvector(
+        db.literal_column("'simple'"),
+        db.func.coalesce(title, '') + ' ' + db.func.coalesce(message, '')
+    )
+
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -21,6 +52,9 @@ class User(db.Model):
     # Relationship to reminders created BY this user
     created_reminders = db.relationship('Reminder', back_populates='creator', lazy=True)
 
+    # Digest and quiet-hours settings, None until the user changes the defaults
+    notification_preference = db.relationship('NotificationPreference', uselist=False, lazy=True)
+
     def __repr__(self):
         return f'<User {self.username}>'
     def to_dict(self):
@@ -31,11 +65,31 @@ class User(db.Model):
             'created_at': self.created_at,
         }
 
+class UserGroup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Dynamic so that large groups are never loaded into memory in one go
+    members = db.relationship('User', secondary=group_members, lazy='dynamic',
+                              backref=db.backref('groups', lazy='dynamic'))
+
+    def __repr__(self):
+        return f'<UserGroup {self.name}>'
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'created_by': self.created_by,
+            'created_at': self.created_at,
+        }
+
 class Reminder(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     message = db.Column(db.Text, nullable=True)
-    due_date = db.Column(db.DateTime, nullable=False)
+    due_date = db.Column(db.DateTime, nullable=False, index=True)
 
     # Foreign key to track the user who created the reminder
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -47,6 +101,15 @@ class Reminder(db.Model):
     recipients = db.relationship('User', secondary=reminder_recipients,
                                  backref=db.backref('reminders_to_receive', lazy='dynamic'))
 
+    # Groups receiving this reminder, stored as one row per group rather than per member
+    recipient_groups = db.relationship('UserGroup', secondary=reminder_group_recipients,
+                                       backref=db.backref('reminders', lazy='dynamic'))
+
+    __table_args__ = (
+        db.Index('ix_reminder_search_vector', _search_vector(title, message),
+                 postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+
     def __repr__(self):
         return f'<Reminder {self.title}>'
     def to_dict(self):
@@ -56,4 +119,179 @@ class Reminder(db.Model):
             'message': self.message,
             'due_date': self.due_date,
             'created_by': self.created_by,
-        }
\ No newline at end of file
+        }
+
+# Expression searched by /reminders/search, backed by a GIN index on PostgreSQL
+reminder_search_vector = _search_vector(Reminder.__table__.c.title, Reminder.__table__.c.message)
+
+
+class ArchivedReminder(db.Model):
+    """
+    Cold storage for reminders whose due date has passed.
+    Rows keep the id they had in the reminder table so clients can still refer to them.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=True)
+    due_date = db.Column(db.DateTime, nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # The users who received this reminder before it was archived
+    recipients = db.relationship('User', secondary=archived_reminder_recipients,
+                                 backref=db.backref('archived_reminders_to_receive', lazy='dynamic'))
+    recipient_groups = db.relationship('UserGroup', secondary=archived_reminder_group_recipients)
+
+    def __repr__(self):
+        return f'<ArchivedReminder {self.title}>'
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'message': self.message,
+            'due_date': self.due_date,
+            'created_by': self.created_by,
+            'archived_at': self.archived_at,
+        }
+
+
+class NotificationPreference(db.Model):
+    """
+    How a user wants to be notified. Reminders coming due within digest_window_minutes of
+    each other are sent as one digest, and nothing is sent between quiet_hours_start and
+    quiet_hours_end (UTC) until the quiet hours are over.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    # None uses the app's NOTIFICATION_DIGEST_WINDOW_MINUTES; 0 sends every reminder on its own
+    digest_window_minutes = db.Column(db.Integer, nullable=True)
+    quiet_hours_start = db.Column(db.Time, nullable=True)
+    quiet_hours_end = db.Column(db.Time, nullable=True)
+
+    def __repr__(self):
+        return f'<NotificationPreference {self.user_id}>'
+    def to_dict(self):
+        return {
+            'digest_window_minutes': self.digest_window_minutes,
+            'quiet_hours_start': self.quiet_hours_start.isoformat() if self.quiet_hours_start else None,
+            'quiet_hours_end': self.quiet_hours_end.isoformat() if self.quiet_hours_end else None,
+        }
+
+
+class PendingNotification(db.Model):
+    """
+    A delivered reminder waiting to be sent as part of a digest, stored on the recipient's
+    home shard. All of a user's pending rows go out together once the earliest send_after passes,
+    and are deleted once sent. sent_at is only set on rows left by earlier versions.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    reminder_id = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    due_date = db.Column(db.DateTime, nullable=False)
+    send_after = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_pending_notification_due', 'sent_at', 'send_after'),
+        db.Index('ix_pending_notification_user', 'user_id', 'sent_at'),
+    )
+
+    def __repr__(self):
+        return f'<PendingNotification {self.title} for {self.user_id}>'
+    def to_dict(self):
+        return {
+            'reminder_id': self.reminder_id,
+            'title': self.title,
+            'due_date': self.due_date,
+        }
+
+
+class InboxEntry(db.Model):
+    """
+    Denormalized copy of a reminder for one direct recipient, stored on the recipient's
+    home shard so the received list is a single-table read. Written by the DAO alongside
+    reminder_recipients; DAO.check_inbox verifies and rebuilds it. Group recipients are
+    not copied here, they are still expanded on read.
+    """
+    __tablename__ = 'inbox'
+    user_id = db.Column(db.Integer, primary_key=True)
+    reminder_id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=True)
+    due_date = db.Column(db.DateTime, nullable=False)
+    created_by = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_inbox_user_due_date', 'user_id', 'due_date'),
+    )
+
+    def __repr__(self):
+        return f'<InboxEntry {self.title} for {self.user_id}>'
+    def to_dict(self):
+        # Same shape as Reminder.to_dict so listings can mix both
+        return {
+            'id': self.reminder_id,
+            'title': self.title,
+            'message': self.message,
+            'due_date': self.due_date,
+            'created_by': self.created_by,
+        }
+
+
+class DeliveryOutbox(db.Model):
+    """
+    Pending deliveries, written in the same transaction as the reminder change that caused them.
+    A row with no user_id stands for every recipient of the reminder, groups included.
+    Workers claim rows by taking a time-limited lease; an expired lease can be claimed again.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    reminder_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    deliver_at = db.Column(db.DateTime, nullable=False)
+    delivered_at = db.Column(db.DateTime, nullable=True)
+    lease_owner = db.Column(db.String(120), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_delivery_outbox_pending', 'delivered_at', 'deliver_at', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<DeliveryOutbox {self.id} reminder={self.reminder_id}>'
+
+
+# Ledger of (reminder, user) pairs already sent, so retried or overlapping outbox rows never send twice
+delivered_reminders = db.Table('delivered_reminders',
+                               db.Column('reminder_id', db.Integer, primary_key=True),
+                               db.Column('user_id', db.Integer, primary_key=True),
+                               db.Column('delivered_at', db.DateTime, default=datetime.utcnow)
+                               )
+
+
+# --- Shard catalog ---
+# These tables are only used on the main database. They issue the user and reminder IDs,
+# which must be unique across shards, and record where each one lives.
+user_directory = db.Table('user_directory',
+                          db.Column('id', db.Integer, primary_key=True),
+                          db.Column('username', db.String(80), unique=True, nullable=False),
+                          db.Column('email', db.String(120), unique=True, nullable=False),
+                          db.Column('shard', db.String(64), nullable=False)
+                          )
+
+reminder_directory = db.Table('reminder_directory',
+                              db.Column('id', db.Integer, primary_key=True),
+                              db.Column('shard', db.String(64), nullable=False)
+                              )
+
+group_directory = db.Table('group_directory',
+                           db.Column('id', db.Integer, primary_key=True),
+                           db.Column('shard', db.String(64), nullable=False)
+                           )
+
+# Shards holding a copy of a user's row so that reminders there can reference them
+user_replicas = db.Table('user_replicas',
+                         db.Column('user_id', db.Integer, primary_key=True),
+                         db.Column('shard', db.String(64), primary_key=True)
+                         )
@@ -0,0 +1,155 @@
+# profiler.py
+
+import sys
+import threading
+import time
+from collections import Counter
+
+# Frames from these modules are counted as response serialization in the breakdown
+_SERIALIZATION_MODULES = ('flask.json', 'json.')
+
+
+def _frame_name(frame):
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+
+def _category(frames):
+    # The outermost DAO call is the public function the route used
+    for name in frames:
+        if name.startswith('DAO.'):
+            return name
+    for name in frames:
+        if name.endswith('.to_dict') or name.startswith(_SERIALIZATION_MODULES):
+            return 'serialization'
+    return 'other'
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the request threads of one worker process.
+    A background thread records the stacks of the threads serving profiled requests every
+    `interval` seconds. While it is not running, the request hooks only check `active`.
+    """
+
+    # Requests mode stops after this long even if the requests never arrive
+    MAX_SECONDS = 300
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.active = False
+        # Incremented by every start so that a sampler left over from an earlier run exits
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._stacks = Counter()
+        self._endpoint = None
+        self._remaining_requests = None
+        self._deadline = None
+        self._sampler = None
+        self.samples = 0
+
+    def start(self, seconds=None, requests=None, endpoint=None):
+        """
+        Starts profiling for a number of seconds, or for the next requests to an endpoint.
+
+        Args:
+            seconds (float, optional): How long to profile every request for. At most MAX_SECONDS.
+            requests (int, optional): How many requests to profile before stopping.
+            endpoint (str, optional): Only profile requests to this endpoint, e.g. 'api.search_reminders'.
+
+        Returns:
+            bool: False if the profiler was already running, True otherwise.
+        """
+        with self._lock:
+            if self.active:
+                return False
+            self._threads.clear()
+            self._stacks.clear()
+            self.samples = 0
+            self._endpoint = endpoint
+            self._remaining_requests = requests
+            self._deadline = time.monotonic() + (seconds or self.MAX_SECONDS)
+            self._generation += 1
+            self.active = True
+            generation = self._generation
+        self._sampler = threading.Thread(target=self._run, args=(generation,), name='sampling-profiler', daemon=True)
+        self._sampler.start()
+        return True
+
+    def stop(self):
+        with self._lock:
+            self.active = False
+            self._threads.clear()
+
+    def request_started(self, endpoint):
+        with self._lock:
+            if not self.active or (self._endpoint and endpoint != self._endpoint):
+                return
+            if self._remaining_requests is not None:
+                if self._remaining_requests <= 0:
+                    return
+                self._remaining_requests -= 1
+            self._threads[threading.get_ident()] = endpoint
+
+    def request_finished(self):
+        with self._lock:
+            self._threads.pop(threading.get_ident(), None)
+            if self._remaining_requests == 0 and not self._threads:
+                self.active = False
+
+    def _running(self, generation):
+        return self.active and self._generation == generation
+
+    def _run(self, generation):
+        own_id = threading.get_ident()
+        while self._running(generation):
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._running(generation):
+                    return
+                if time.monotonic() >= self._deadline:
+                    self.active = False
+                    self._threads.clear()
+                    return
+                threads = dict(self._threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for thread_id, endpoint in threads.items():
+                frame = frames.get(thread_id)
+                if frame is None or thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(endpoint)
+                stack.reverse()
+                with self._lock:
+                    if not self._running(generation):
+                        return
+                    self._stacks[tuple(stack)] += 1
+                    self.samples += 1
+
+    def collapsed(self):
+        """
+        Returns the samples as collapsed stacks ("root;...;leaf count" per line),
+        the input format of flamegraph.pl and speedscope. Each stack starts at the endpoint.
+        """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in stacks)
+
+    def breakdown(self):
+        """
+        Returns the number of samples spent in each DAO function, in serialization, and elsewhere.
+        """
+        totals = Counter()
+        with self._lock:
+            for stack, count in self._stacks.items():
+                totals[_category(stack)] += count
+        return dict(totals.most_common())
+
+
+# One profiler per worker process, driven by the /admin/profile routes
+profiler = SamplingProfiler()
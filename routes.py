@@ -1,20 +1,20 @@
-import os
-import datetime
-from datetime import timedelta, timezone
+from datetime import datetime, time, timedelta, timezone
 from functools import wraps
-from flask import Blueprint, jsonify, request
-from flask.cli import load_dotenv
-from DAO import *
-from models import *
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from flask import Blueprint, Response, current_app, jsonify, request
 import jwt
 
-load_dotenv()
+import config
+from extensions import db
+from profiler import profiler
+from DAO import (search_user_by_email, search_user_by_id, add_user, add_reminder_for_user_with_id,
+                 get_reminders_for_user, get_archived_reminders_for_user, search_reminders_for_user,
+                 get_reminders, delete_reminder, create_group, add_members_to_group,
+                 get_notification_preferences, set_notification_preferences)
+
+# google-auth is imported inside google_signin so that workers only pay for it when it is used
 api_bp = Blueprint('api', __name__)
-GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
-SECRET_KEY = os.getenv('SECRET_KEY')
-print(SECRET_KEY)
+GOOGLE_CLIENT_ID = config.GOOGLE_CLIENT_ID
+SECRET_KEY = config.SECRET_KEY
 class UserCreationError(Exception):
     pass
 
@@ -27,9 +27,7 @@ def jwt_required(func):
             return jsonify({"msg": "Missing or invalid Authorization header"}), 401
 
         token = auth_header.split(" ")[1]
-        print(token)
         try:
-            print(SECRET_KEY)
             payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
             request.user_id = payload.get("sub")
             request.user_email = payload.get("email")
@@ -42,6 +40,16 @@ def jwt_required(func):
 
     return wrapper
 
+def admin_required(func):
+    @wraps(func)
+    @jwt_required
+    def wrapper(*args, **kwargs):
+        if str(request.user_id) not in config.ADMIN_USER_IDS:
+            return jsonify({"msg": "Admin access required"}), 403
+        return func(*args, **kwargs)
+
+    return wrapper
+
 def get_user_by_email(user_email):
     try:
         user = search_user_by_email(user_email)
@@ -61,6 +69,19 @@ def register_user(username, email):
     except Exception as e:
         raise UserCreationError(f"An error occurred while registering user: {e}")
 
+# ------- Profiler hooks
+# Only an attribute check per request while the profiler is off
+
+@api_bp.before_request
+def start_request_profile():
+    if profiler.active:
+        profiler.request_started(request.endpoint)
+
+@api_bp.teardown_request
+def finish_request_profile(exc):
+    if profiler.active:
+        profiler.request_finished()
+
 # ------- API Routes
 
 @api_bp.route('/')
@@ -88,6 +109,47 @@ def get_reminder_by_user_id():
         return jsonify(data), 200
     return jsonify({"message": "Reminder not found"}), 404
 
+@api_bp.route('/reminders/archive/get', methods=['GET'])
+@jwt_required
+def get_archived_reminder_by_user_id():
+    user_id = getattr(request, "user_id", None)
+    try:
+        reminders = get_archived_reminders_for_user(user_id)
+    except Exception as e:
+        return jsonify({"message": str(e)}), 404
+    data = {
+        "created": [reminder.to_dict() for reminder in reminders["created"]],
+        "received": [reminder.to_dict() for reminder in reminders["received"]],
+    }
+    return jsonify(data), 200
+
+@api_bp.route('/reminders/search', methods=['GET'])
+@jwt_required
+def search_reminders():
+    user_id = getattr(request, "user_id", None)
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"message": "Missing required parameter: q"}), 400
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('per_page', 20))
+    except ValueError:
+        return jsonify({"message": "page and per_page must be integers"}), 400
+    if page < 1 or not 1 <= per_page <= 100:
+        return jsonify({"message": "page must be >= 1 and per_page between 1 and 100"}), 400
+
+    try:
+        found = search_reminders_for_user(user_id, query, page, per_page)
+    except Exception as e:
+        return jsonify({"message": str(e)}), 404
+    data = {
+        "results": [reminder.to_dict() for reminder in found["results"]],
+        "page": page,
+        "per_page": per_page,
+        "total": found["total"],
+    }
+    return jsonify(data), 200
+
 @api_bp.route('/reminders/add', methods=['POST'])
 @jwt_required
 def add_reminder():
@@ -107,6 +169,7 @@ def add_reminder():
     user_id = data['user_id']
     message = data.get('message')  # Optional field
     recipient_ids = data.get('recipient_ids') # Optional field for shared reminders
+    group_ids = data.get('group_ids') # Optional field for reminders shared with whole groups
 
     # --- 2. Validate Data Types and Formats ---
     try:
@@ -123,7 +186,7 @@ def add_reminder():
         return jsonify({"message": f"User {user_id} not found"}), 404
     # --- 3. Create and Save the Reminder ---
     try:
-        new_reminder = add_reminder_for_user_with_id(title, message, due_date, user_id, recipient_ids)
+        new_reminder = add_reminder_for_user_with_id(title, message, due_date, user_id, recipient_ids, group_ids)
         data = {
             "message": "Reminder created successfully",
             "reminder": new_reminder.to_dict() # Return the created reminder's data
@@ -161,12 +224,137 @@ def remove_reminder():
         return jsonify({"message": "An error occurred", "error": str(e)}), 500
     return jsonify({"message": "Reminder removed successfully"}), 200
 
+@api_bp.route('/groups/add', methods=['POST'])
+@jwt_required
+def add_group():
+    if not request.is_json:
+        return jsonify({"message": "Request must be JSON"}), 400
+    data = request.get_json()
+    if 'name' not in data:
+        return jsonify({"message": "Missing required field: name"}), 400
+
+    user_id = int(getattr(request, "user_id", None))
+    try:
+        group = create_group(data['name'], user_id, data.get('member_ids'))
+    except Exception as e:
+        return jsonify({"message": "An error occurred while creating the group", "error": str(e)}), 500
+    return jsonify({"message": "Group created successfully", "group": group.to_dict()}), 201
+
+@api_bp.route('/groups/members/add', methods=['POST'])
+@jwt_required
+def add_group_members():
+    if not request.is_json:
+        return jsonify({"message": "Request must be JSON"}), 400
+    data = request.get_json()
+    required_fields = ['group_id', 'member_ids']
+    for field in required_fields:
+        if field not in data:
+            return jsonify({"message": f"Missing required field: {field}"}), 400
+
+    user_id = int(getattr(request, "user_id", None))
+    try:
+        added = add_members_to_group(data['group_id'], user_id, data['member_ids'])
+    except Exception as e:
+        return jsonify({"message": "An error occurred while adding group members", "error": str(e)}), 500
+    return jsonify({"message": "Group members added successfully", "added": added}), 200
+
+@api_bp.route('/users/notification-preferences', methods=['GET'])
+@jwt_required
+def get_user_notification_preferences():
+    user_id = getattr(request, "user_id", None)
+    try:
+        preference = get_notification_preferences(user_id)
+    except Exception as e:
+        return jsonify({"message": str(e)}), 404
+    return jsonify(preference.to_dict()), 200
+
+@api_bp.route('/users/notification-preferences', methods=['POST'])
+@jwt_required
+def set_user_notification_preferences():
+    if not request.is_json:
+        return jsonify({"message": "Request must be JSON"}), 400
+    data = request.get_json()
+    user_id = getattr(request, "user_id", None)
+
+    # All fields are optional; a missing field restores its default
+    try:
+        digest_window_minutes = data.get('digest_window_minutes')
+        if digest_window_minutes is not None:
+            digest_window_minutes = int(digest_window_minutes)
+        quiet_hours_start = data.get('quiet_hours_start')
+        quiet_hours_end = data.get('quiet_hours_end')
+        if quiet_hours_start is not None:
+            quiet_hours_start = time.fromisoformat(quiet_hours_start)
+        if quiet_hours_end is not None:
+            quiet_hours_end = time.fromisoformat(quiet_hours_end)
+    except (TypeError, ValueError):
+        return jsonify({"message": "Invalid preferences. Use an integer window and HH:MM quiet hours."}), 400
+
+    try:
+        preference = set_notification_preferences(user_id, digest_window_minutes, quiet_hours_start, quiet_hours_end)
+    except Exception as e:
+        return jsonify({"message": "An error occurred while saving preferences", "error": str(e)}), 400
+    return jsonify(preference.to_dict()), 200
+
+@api_bp.route('/admin/profile', methods=['POST'])
+@admin_required
+def start_profile():
+    """
+    Profiles this worker for `seconds`, or for the next `requests` requests to `endpoint`.
+    Requests mode also stops after the profiler's MAX_SECONDS.
+    """
+    if not request.is_json:
+        return jsonify({"message": "Request must be JSON"}), 400
+    data = request.get_json()
+    try:
+        seconds = float(data['seconds']) if data.get('seconds') is not None else None
+        requests = int(data['requests']) if data.get('requests') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"message": "seconds and requests must be numbers"}), 400
+    if (seconds is None) == (requests is None):
+        return jsonify({"message": "Provide exactly one of seconds or requests"}), 400
+    if (seconds is not None and not 0 < seconds <= profiler.MAX_SECONDS) or (requests is not None and not 0 < requests <= 1000):
+        return jsonify({"message": f"Profile at most {profiler.MAX_SECONDS} seconds or 1000 requests"}), 400
+
+    endpoint = data.get('endpoint')
+    if endpoint and not endpoint.startswith(f"{api_bp.name}."):
+        endpoint = f"{api_bp.name}.{endpoint}"
+    if endpoint and endpoint not in current_app.view_functions:
+        return jsonify({"message": f"Unknown endpoint: {endpoint}"}), 400
+    if not profiler.start(seconds=seconds, requests=requests, endpoint=endpoint):
+        return jsonify({"message": "Profiler is already running"}), 409
+    return jsonify({"message": "Profiler started", "seconds": seconds, "requests": requests, "endpoint": endpoint}), 202
+
+@api_bp.route('/admin/profile', methods=['GET'])
+@admin_required
+def get_profile():
+    """
+    Returns the samples as collapsed stacks for flamegraph.pl / speedscope,
+    or with ?format=json, the time spent per DAO function and in serialization as well.
+    """
+    if request.args.get('format') == 'json':
+        return jsonify({
+            "active": profiler.active,
+            "samples": profiler.samples,
+            "breakdown": profiler.breakdown(),
+            "stacks": profiler.collapsed().splitlines(),
+        }), 200
+    return Response(profiler.collapsed() + "\n", mimetype='text/plain')
+
+@api_bp.route('/admin/profile/stop', methods=['POST'])
+@admin_required
+def stop_profile():
+    profiler.stop()
+    return jsonify({"message": "Profiler stopped", "samples": profiler.samples}), 200
+
 @api_bp.route('/google/signin', methods=['POST'])
 def google_signin():
     # The ID token is sent in the request body
     token = request.json.get("id_token")
     if not token:
         return jsonify({"error": "No ID token provided"}), 400
+    from google.oauth2 import id_token
+    from google.auth.transport import requests
     try:
         # Validate the token
         idinfo = id_token.verify_oauth2_token(token, requests.Request(), GOOGLE_CLIENT_ID)
@@ -195,7 +383,6 @@ def google_signin():
                 'exp': datetime.now(timezone.utc) + timedelta(hours=24),
                 }
             token = jwt.encode(payload, SECRET_KEY, algorithm='HS256')
-            print(token)
             return jsonify(
                 {
                     "token": token,
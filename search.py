@@ -0,0 +1,70 @@
+# search.py
+
+import math
+import re
+from collections import defaultdict
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Splits text into lower-cased word tokens.
+
+    Args:
+        text (str): The text to tokenize. None is treated as empty.
+
+    Returns:
+        list[str]: The tokens in order of appearance.
+    """
+    if not text:
+        return []
+    return _TOKEN_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """
+    In-process inverted index over reminder titles and messages.
+    Used as the search backend when the database has no full-text support (SQLite).
+    It is built for each query from the reminders in scope, so a search costs a scan of them;
+    this is for development and tests only. Production deployments use PostgreSQL.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)  # term -> {reminder_id: term frequency}
+        self.documents = {}
+
+    def add(self, reminder):
+        self.documents[reminder.id] = reminder
+        for term in tokenize(reminder.title) + tokenize(reminder.message):
+            postings = self.postings[term]
+            postings[reminder.id] = postings.get(reminder.id, 0) + 1
+
+    def search(self, query):
+        """
+        Ranks indexed reminders against a query with TF-IDF scoring.
+        Every query term must appear in a reminder for it to match.
+
+        Args:
+            query (str): The search text.
+
+        Returns:
+            list: Matching reminders, best match first, ties broken by due date.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        postings = [self.postings.get(term, {}) for term in terms]
+        matches = set.intersection(*(set(posting) for posting in postings))
+        total = len(self.documents)
+        scores = dict.fromkeys(matches, 0.0)
+        for posting in postings:
+            idf = math.log(1 + total / len(posting)) if posting else 0.0
+            for reminder_id in matches:
+                scores[reminder_id] += posting[reminder_id] * idf
+
+        return sorted(
+            (self.documents[reminder_id] for reminder_id in matches),
+            key=lambda reminder: (-scores[reminder.id], reminder.due_date),
+        )
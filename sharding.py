@@ -0,0 +1,482 @@
+# sharding.py
+"""
+Routes DAO calls to the database (shard) that owns the data.
+
+Every user has a home shard holding their row, the reminders they created, their
+groups and the outbox entries for those reminders. A reminder shared with a user
+from another shard stays on its creator's shard; the recipient's user row is
+copied there (a replica) so that reminder_recipients can still reference it.
+
+Extra shards are configured with SHARD_DATABASE_URLS. The main DATABASE_URL is the
+'default' shard and also holds the catalog tables from models.py. Without extra
+shards every helper here falls straight through to the single database.
+"""
+
+import inspect
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from extensions import db, current_shard
+from models import (User, UserGroup, Reminder, ArchivedReminder, DeliveryOutbox, InboxEntry,
+                    NotificationPreference, PendingNotification, group_members,
+                    reminder_recipients, reminder_group_recipients, archived_reminder_recipients,
+                    archived_reminder_group_recipients, delivered_reminders, user_directory,
+                    reminder_directory, group_directory, user_replicas)
+
+DEFAULT_SHARD = 'default'
+
+
+def shard_binds(urls):
+    """
+    Builds the SQLALCHEMY_BINDS entries for the extra shards.
+
+    Args:
+        urls (list[str]): Database URLs of the shards besides the default one.
+
+    Returns:
+        dict: Bind keys 'shard1', 'shard2', ... mapped to their URLs.
+    """
+    return {f'shard{number}': url for number, url in enumerate(urls, start=1)}
+
+
+def all_shards():
+    return [DEFAULT_SHARD] + sorted((key for key in db.engines if key is not None),
+                                    key=lambda key: (len(key), key))
+
+
+def is_sharded():
+    return len(db.engines) > 1
+
+
+def active_shard():
+    return current_shard.get() or DEFAULT_SHARD
+
+
+@contextmanager
+def use_shard(shard):
+    """
+    Runs the enclosed queries against the given shard.
+    """
+    if shard == active_shard():
+        yield
+        return
+    token = current_shard.set(shard)
+    try:
+        # Pending objects belong to the shard they were created on, never flush them elsewhere
+        with db.session.no_autoflush:
+            yield
+    finally:
+        current_shard.reset(token)
+
+
+def create_all_shards():
+    db.create_all()
+    for shard in all_shards()[1:]:
+        db.metadata.create_all(db.engines[shard])
+
+
+# --- Catalog lookups ---
+
+def _catalog_scalar(statement):
+    with use_shard(DEFAULT_SHARD):
+        return db.session.execute(statement).scalar()
+
+
+def shard_for_user(user_id):
+    return _catalog_scalar(db.select(user_directory.c.shard).where(user_directory.c.id == user_id))
+
+
+def shard_for_username(username):
+    return _catalog_scalar(db.select(user_directory.c.shard).where(user_directory.c.username == username))
+
+
+def shard_for_email(email):
+    return _catalog_scalar(db.select(user_directory.c.shard).where(user_directory.c.email == email))
+
+
+def shard_for_reminder(reminder_id):
+    return _catalog_scalar(db.select(reminder_directory.c.shard).where(reminder_directory.c.id == reminder_id))
+
+
+def shards_for_user(user_id):
+    """
+    Lists the shards that may hold reminders a user receives: their home shard first,
+    then every shard holding a replica of their row.
+    """
+    if not is_sharded():
+        return [DEFAULT_SHARD]
+    home = shard_for_user(user_id) or DEFAULT_SHARD
+    with use_shard(DEFAULT_SHARD):
+        replicas = db.session.execute(
+            db.select(user_replicas.c.shard).where(user_replicas.c.user_id == user_id)
+        ).scalars().all()
+    return [home] + sorted(set(replicas) - {home})
+
+
+def _group_by_directory(directory, ids):
+    if not is_sharded():
+        return {active_shard(): list(ids)} if ids else {}
+    with use_shard(DEFAULT_SHARD):
+        rows = db.session.execute(
+            db.select(directory.c.id, directory.c.shard).where(directory.c.id.in_(ids))
+        ).all()
+    grouped = defaultdict(list)
+    for entity_id, shard in rows:
+        grouped[shard].append(entity_id)
+    return grouped
+
+
+def group_by_home_shard(user_ids):
+    """
+    Splits user IDs by home shard. IDs missing from the catalog are dropped.
+
+    Returns:
+        dict: Shard mapped to the list of IDs living there.
+    """
+    return _group_by_directory(user_directory, user_ids)
+
+
+def group_by_group_shard(group_ids):
+    """
+    Splits group IDs by the shard storing them, which is their owner's home.
+    IDs missing from the catalog are dropped.
+
+    Returns:
+        dict: Shard mapped to the list of IDs stored there.
+    """
+    return _group_by_directory(group_directory, group_ids)
+
+
+def group_by_reminder_shard(reminder_ids):
+    """
+    Splits reminder IDs by the shard storing them. IDs missing from the catalog are dropped.
+
+    Returns:
+        dict: Shard mapped to the list of IDs stored there.
+    """
+    return _group_by_directory(reminder_directory, reminder_ids)
+
+
+def routed(lookup, arg):
+    """
+    Decorator running a DAO function on the shard found by passing its `arg` argument to `lookup`.
+    Unknown keys go to the default shard, where the function reports them as not found.
+
+    A failed call rolls the session back, which expires every loaded instance. With shards an
+    expired instance reloads from whichever shard is active when it is next touched, usually
+    the default one, so instances loaded before a failed call must not be reused; look them
+    up again by ID.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def shard_of(args, kwargs):
+            return lookup(signature.bind(*args, **kwargs).arguments.get(arg)) or DEFAULT_SHARD
+
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if not is_sharded():
+                    yield from func(*args, **kwargs)
+                    return
+                shard = shard_of(args, kwargs)
+                generator = func(*args, **kwargs)
+                # Only the generator's own work runs on the shard, not the caller's between items
+                while True:
+                    with use_shard(shard):
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            return
+                    yield item
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_sharded():
+                return func(*args, **kwargs)
+            with use_shard(shard_of(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Catalog writes ---
+
+def allocate_user(username, email):
+    """
+    Registers a new user in the catalog and picks their home shard.
+
+    Args:
+        username (str): The new user's username.
+        email (str): The new user's email.
+
+    Returns:
+        tuple: The globally unique user ID and the home shard for the user.
+    """
+    shards = all_shards()
+    with use_shard(DEFAULT_SHARD):
+        taken = db.session.execute(
+            db.select(user_directory.c.id)
+            .where((user_directory.c.username == username) | (user_directory.c.email == email))
+        ).first()
+        if taken:
+            raise Exception('User already exists')
+        user_id = db.session.execute(
+            user_directory.insert().values(username=username, email=email, shard=DEFAULT_SHARD)
+        ).inserted_primary_key[0]
+        shard = shards[user_id % len(shards)]
+        db.session.execute(user_directory.update().where(user_directory.c.id == user_id).values(shard=shard))
+    return user_id, shard
+
+
+def allocate_reminder_id():
+    """
+    Issues a globally unique ID for a reminder created on the active shard.
+
+    Returns:
+        int: The new reminder ID, or None without sharding so the database assigns one.
+    """
+    if not is_sharded():
+        return None
+    shard = active_shard()
+    with use_shard(DEFAULT_SHARD):
+        return db.session.execute(reminder_directory.insert().values(shard=shard)).inserted_primary_key[0]
+
+
+def allocate_group_id():
+    """
+    Issues a globally unique ID for a group created on the active shard.
+    Group IDs are handed to clients, so they must not collide across shards or change on a move.
+
+    Returns:
+        int: The new group ID, or None without sharding so the database assigns one.
+    """
+    if not is_sharded():
+        return None
+    shard = active_shard()
+    with use_shard(DEFAULT_SHARD):
+        return db.session.execute(group_directory.insert().values(shard=shard)).inserted_primary_key[0]
+
+
+def replicate_users(user_ids):
+    """
+    Copies the rows of users whose home is another shard onto the active shard,
+    so reminders and groups there can reference them. IDs not in the catalog are ignored.
+
+    Args:
+        user_ids (list[int]): The users that are about to be referenced.
+    """
+    if not is_sharded() or not user_ids:
+        return
+    shard = active_shard()
+    user_ids = {int(user_id) for user_id in user_ids}
+    present = set(db.session.execute(db.select(User.id).where(User.id.in_(user_ids))).scalars())
+    missing = user_ids - present
+    if not missing:
+        return
+
+    with use_shard(DEFAULT_SHARD):
+        homes = db.session.execute(
+            db.select(user_directory.c.id, user_directory.c.shard).where(user_directory.c.id.in_(missing))
+        ).all()
+    by_home = defaultdict(list)
+    for user_id, home in homes:
+        by_home[home].append(user_id)
+
+    rows = []
+    for home, ids in by_home.items():
+        with use_shard(home):
+            rows.extend(dict(row._mapping) for row in db.session.execute(
+                db.select(User.__table__).where(User.id.in_(ids))
+            ))
+    if not rows:
+        return
+    db.session.execute(User.__table__.insert(), rows)
+    with use_shard(DEFAULT_SHARD):
+        db.session.execute(user_replicas.insert(), [{"user_id": row["id"], "shard": shard} for row in rows])
+
+
+def build_directory():
+    """
+    Catalogs users, reminders and groups that were created before sharding was enabled.
+    Run once, with only the default shard holding data, before adding shards.
+
+    Returns:
+        int: The number of catalog entries written.
+    """
+    try:
+        with use_shard(DEFAULT_SHARD):
+            users = db.session.execute(
+                db.select(User.id, User.username, User.email)
+                .where(User.id.not_in(db.select(user_directory.c.id)))
+            ).all()
+            reminder_ids = db.session.execute(
+                db.select(Reminder.id).where(Reminder.id.not_in(db.select(reminder_directory.c.id)))
+                .union(db.select(ArchivedReminder.id)
+                       .where(ArchivedReminder.id.not_in(db.select(reminder_directory.c.id))))
+            ).scalars().all()
+            group_ids = db.session.execute(
+                db.select(UserGroup.id).where(UserGroup.id.not_in(db.select(group_directory.c.id)))
+            ).scalars().all()
+            if users:
+                db.session.execute(user_directory.insert(), [
+                    {"id": user_id, "username": username, "email": email, "shard": DEFAULT_SHARD}
+                    for user_id, username, email in users
+                ])
+            if reminder_ids:
+                db.session.execute(reminder_directory.insert(), [
+                    {"id": reminder_id, "shard": DEFAULT_SHARD} for reminder_id in reminder_ids
+                ])
+            if group_ids:
+                db.session.execute(group_directory.insert(), [
+                    {"id": group_id, "shard": DEFAULT_SHARD} for group_id in group_ids
+                ])
+            if db.session.get_bind().dialect.name == 'postgresql':
+                # Explicit IDs do not advance the sequences that issue new ones
+                for table in (user_directory, reminder_directory, group_directory):
+                    db.session.execute(db.text(
+                        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                        f"COALESCE((SELECT MAX(id) FROM {table.name}), 1))"
+                    ))
+        db.session.commit()
+        return len(users) + len(reminder_ids) + len(group_ids)
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while building the shard directory: {e}")
+
+
+# --- Rebalancing ---
+
+def _select_rows(table, *criteria):
+    return [dict(row._mapping) for row in db.session.execute(db.select(table).where(*criteria))]
+
+
+def move_user_to_shard(user_id, target):
+    """
+    Rebalancing tool: moves a user's home, and everything stored under it, to another shard.
+    Copies the user, their inbox, notification settings and pending digests, the reminders
+    and archived reminders they created with their recipients, their groups, and the outbox
+    and delivery records of their reminders. The old shard keeps a replica of the user row
+    for other people's reminders that still reference them.
+
+    Writes to the user should be paused while this runs; the copy is committed on each
+    database in turn rather than atomically.
+
+    Args:
+        user_id (int): The ID of the user to move.
+        target (str): The shard to move them to.
+
+    Returns:
+        int: The number of reminders (hot and archived) that were moved.
+    """
+    source = shard_for_user(user_id)
+    if source is None:
+        raise Exception(f"Error: User with ID {user_id} not found.")
+    if target not in all_shards():
+        raise Exception(f"Error: Shard {target} is not configured.")
+    if source == target:
+        return 0
+
+    try:
+        with use_shard(source):
+            user_row = _select_rows(User.__table__, User.id == user_id)[0]
+            inbox = _select_rows(InboxEntry.__table__, InboxEntry.user_id == user_id)
+            preferences = _select_rows(NotificationPreference.__table__, NotificationPreference.user_id == user_id)
+            notifications = _select_rows(PendingNotification.__table__, PendingNotification.user_id == user_id)
+            groups = _select_rows(UserGroup.__table__, UserGroup.created_by == user_id)
+            group_ids = [group["id"] for group in groups]
+            reminders = _select_rows(Reminder.__table__, Reminder.created_by == user_id)
+            reminder_ids = [reminder["id"] for reminder in reminders]
+            archived = _select_rows(ArchivedReminder.__table__, ArchivedReminder.created_by == user_id)
+            archived_ids = [reminder["id"] for reminder in archived]
+
+            # Groups move with their owner, so reminders left behind on this shard must not use them
+            foreign_uses = db.session.execute(
+                db.select(reminder_group_recipients.c.reminder_id)
+                .where(reminder_group_recipients.c.group_id.in_(group_ids),
+                       reminder_group_recipients.c.reminder_id.not_in(reminder_ids))
+                .union(db.select(archived_reminder_group_recipients.c.reminder_id)
+                       .where(archived_reminder_group_recipients.c.group_id.in_(group_ids),
+                              archived_reminder_group_recipients.c.reminder_id.not_in(archived_ids)))
+            ).first()
+            if foreign_uses:
+                raise Exception(f"Error: Groups of user {user_id} are used by other users' reminders.")
+
+            members = _select_rows(group_members, group_members.c.group_id.in_(group_ids))
+            recipients = _select_rows(reminder_recipients, reminder_recipients.c.reminder_id.in_(reminder_ids))
+            group_recipients = _select_rows(reminder_group_recipients,
+                                            reminder_group_recipients.c.reminder_id.in_(reminder_ids))
+            archived_recipients = _select_rows(archived_reminder_recipients,
+                                               archived_reminder_recipients.c.reminder_id.in_(archived_ids))
+            archived_group_recipients = _select_rows(archived_reminder_group_recipients,
+                                                     archived_reminder_group_recipients.c.reminder_id.in_(archived_ids))
+            outbox = _select_rows(DeliveryOutbox.__table__, DeliveryOutbox.reminder_id.in_(reminder_ids))
+            deliveries = _select_rows(delivered_reminders,
+                                      delivered_reminders.c.reminder_id.in_(reminder_ids + archived_ids))
+
+        with use_shard(target):
+            if not db.session.execute(db.select(User.id).where(User.id == user_id)).first():
+                db.session.execute(User.__table__.insert(), [user_row])
+            replicate_users({row["user_id"] for row in members + recipients + archived_recipients} - {user_id})
+
+            # Outbox and notification IDs are local; group IDs come from the catalog and are kept
+            for row in outbox + notifications:
+                row.pop("id")
+
+            for table, rows in ((UserGroup.__table__, groups),
+                                (InboxEntry.__table__, inbox),
+                                (NotificationPreference.__table__, preferences),
+                                (PendingNotification.__table__, notifications),
+                                (group_members, members),
+                                (Reminder.__table__, reminders),
+                                (reminder_recipients, recipients),
+                                (reminder_group_recipients, group_recipients),
+                                (ArchivedReminder.__table__, archived),
+                                (archived_reminder_recipients, archived_recipients),
+                                (archived_reminder_group_recipients, archived_group_recipients),
+                                (DeliveryOutbox.__table__, outbox),
+                                (delivered_reminders, deliveries)):
+                if rows:
+                    db.session.execute(table.insert(), rows)
+
+        with use_shard(source):
+            for table, criterion in (
+                    (delivered_reminders, delivered_reminders.c.reminder_id.in_(reminder_ids + archived_ids)),
+                    (DeliveryOutbox.__table__, DeliveryOutbox.reminder_id.in_(reminder_ids)),
+                    (archived_reminder_group_recipients, archived_reminder_group_recipients.c.reminder_id.in_(archived_ids)),
+                    (archived_reminder_recipients, archived_reminder_recipients.c.reminder_id.in_(archived_ids)),
+                    (ArchivedReminder.__table__, ArchivedReminder.id.in_(archived_ids)),
+                    (reminder_group_recipients, reminder_group_recipients.c.reminder_id.in_(reminder_ids)),
+                    (reminder_recipients, reminder_recipients.c.reminder_id.in_(reminder_ids)),
+                    (Reminder.__table__, Reminder.id.in_(reminder_ids)),
+                    (group_members, group_members.c.group_id.in_(group_ids)),
+                    (UserGroup.__table__, UserGroup.id.in_(group_ids)),
+                    (InboxEntry.__table__, InboxEntry.user_id == user_id),
+                    (NotificationPreference.__table__, NotificationPreference.user_id == user_id),
+                    (PendingNotification.__table__, PendingNotification.user_id == user_id)):
+                db.session.execute(table.delete().where(criterion))
+
+        with use_shard(DEFAULT_SHARD):
+            db.session.execute(user_directory.update()
+                               .where(user_directory.c.id == user_id).values(shard=target))
+            db.session.execute(reminder_directory.update()
+                               .where(reminder_directory.c.id.in_(reminder_ids + archived_ids))
+                               .values(shard=target))
+            db.session.execute(group_directory.update()
+                               .where(group_directory.c.id.in_(group_ids))
+                               .values(shard=target))
+            db.session.execute(user_replicas.delete()
+                               .where(user_replicas.c.user_id == user_id, user_replicas.c.shard == target))
+            db.session.execute(user_replicas.insert().values(user_id=user_id, shard=source))
+
+        db.session.commit()
+        # Cached instances may still describe the old placement
+        db.session.expunge_all()
+        print(f"Moved user {user_id} from {source} to {target}.")
+        return len(reminder_ids) + len(archived_ids)
+
+    except Exception as e:
+        db.session.rollback()
+        raise Exception(f"An error occurred while moving user {user_id}: {e}")